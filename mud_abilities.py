@@ -135,6 +135,26 @@ class LearnedAbility:
         self.sublevel = sublevel
         self.experience = experience
         self.is_locked = False  # Additional feature, for locking abilities under certain conditions
+
+    def to_dict(self):
+        # Abilities pickled before sublevel and is_locked were added don't have them
+        sublevel = getattr(self, 'sublevel', None)
+        if sublevel is None:
+            sublevel = min(int(self.experience / self.calculate_required_exp() * 5) + 1, 5)
+        return {
+            'name': self.name,
+            'type': self.type.name,
+            'level': self.level,
+            'sublevel': sublevel,
+            'experience': self.experience,
+            'is_locked': getattr(self, 'is_locked', False),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        ability = cls(data['name'], AbilityType[data['type']], data.get('level', 1), data.get('sublevel', 1), data.get('experience', 0))
+        ability.is_locked = data.get('is_locked', False)
+        return ability
             
     def gain_experience(self, amount):
         if not self.is_locked:
@@ -213,12 +233,26 @@ class LearnedAbility:
         return self.level, self.sublevel
         
 class Abilities:
+    version = 0 # bumped when an ability is learned or gains experience, see Player.get_version
+
     def __init__(self):
         self.abilities = {}
 
+    def to_dict(self):
+        return {'abilities': [ability.to_dict() for ability in self.abilities.values()]}
+
+    @classmethod
+    def from_dict(cls, data):
+        abilities = cls()
+        for ability_data in data.get('abilities', ()):
+            ability = LearnedAbility.from_dict(ability_data)
+            abilities.abilities[ability.name] = ability
+        return abilities
+
     def learn_ability(self, ability_name, ability_type):
         if ability_name not in self.abilities:
             self.abilities[ability_name] = LearnedAbility(ability_name, ability_type)
+            self.version += 1
             return random.choice(StudyMessages) + "\n"
 
     def has_ability(self, ability_name):
@@ -229,6 +263,7 @@ class Abilities:
 
             # chance to gain 1 extra experience
             if random.random() <= 0.25:
+                self.version += 1
                 return self.abilities[ability_name].gain_experience(10) # lower to 1 after beta testing
             return ""
                 
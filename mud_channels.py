@@ -0,0 +1,89 @@
+# mud_channels.py
+
+class Channel:
+    """
+    A global channel such as chat or info.
+
+    Players are subscribed when they log in, apart from channels they have muted, and unsubscribed
+    when they disconnect. A broadcast is encoded once and the same bytes are added to every
+    subscriber's output buffer.
+    """
+    def __init__(self, name, colour, description):
+        self.name = name
+        self.colour = colour
+        self.description = description
+        self.subscribers = set()
+
+    def subscribe(self, player):
+        self.subscribers.add(player)
+
+    def unsubscribe(self, player):
+        self.subscribers.discard(player)
+
+    def is_subscribed(self, player):
+        return player in self.subscribers
+
+    def broadcast(self, msg, excluded_player=None):
+        """
+        Sends a message to every subscriber of the channel.
+
+        Args:
+            msg (str): The message to be sent, already coloured.
+            excluded_player (Player, optional): A player who should not receive the message, eg the player chatting. Defaults to None.
+
+        Returns:
+            None
+        """
+        data = msg.encode('utf-8', errors='replace')
+        for player in self.subscribers:
+            if player is not excluded_player:
+                player.output_buffer.write_encoded(data)
+
+class ChannelManager:
+    def __init__(self):
+        self.channels = {}
+
+    def add(self, channel):
+        self.channels[channel.name] = channel
+
+    def get(self, name):
+        return self.channels.get(name)
+
+    def get_all(self):
+        return self.channels.values()
+
+    def find(self, name):
+        """
+        Returns the first channel whose name starts with name, or None.
+        """
+        name = name.lower()
+        for channel in self.channels.values():
+            if channel.name.startswith(name):
+                return channel
+        return None
+
+    def login(self, player):
+        for channel in self.channels.values():
+            if channel.name not in player.character.muted_channels:
+                channel.subscribe(player)
+
+    def logout(self, player):
+        for channel in self.channels.values():
+            channel.unsubscribe(player)
+
+    def mute(self, player, channel):
+        player.character.muted_channels.add(channel.name)
+        player.character.version += 1
+        channel.unsubscribe(player)
+
+    def unmute(self, player, channel):
+        player.character.muted_channels.discard(channel.name)
+        player.character.version += 1
+        channel.subscribe(player)
+
+# Init Global channel manager
+channel_manager = ChannelManager()
+channel_manager.add(Channel("chat", "cyan", "Global chat between players"))
+channel_manager.add(Channel("info", "red", "Players entering and leaving the game"))
+channel_manager.add(Channel("deaths", "red", "Player deaths"))
+channel_manager.add(Channel("levels", "red", "Players gaining levels"))
@@ -7,7 +7,7 @@ from mud_consts import Exits, RoomFlags
 from mud_shared import log_info, log_error, dice_roll, random_percent, colourize, first_to_upper, report_mob_health, check_flag
 
 from mud_world import mob_instance_manager
-from mud_comms import send_room_message_processing, send_message, send_room_message, send_global_message, send_info_message
+from mud_comms import send_room_message_processing, send_message, send_room_message, send_info_message
 from mud_objects import combat_manager, room_manager, reset_manager
 
 def return_PC_and_NPC(character_one, character_two):
@@ -50,16 +50,16 @@ def process_victory(player, mob_level):
     if gain_msg != "":
         # Level!
         send_message(player, colourize(gain_msg,"cyan"))
-        send_info_message(f"{player.name} has reached level {player.character.level}!")
+        send_info_message(f"{player.name} has reached level {player.character.level}!", channel="levels")
 
 def process_PC_death(player, mob=None):
     combat_manager.end_combat_with_all(player)
     send_room_message(player.current_room, colourize(f"{player.name} is dead!!!\n", "red"), excluded_player=player, excluded_msg=colourize("You are dead!!!", "red"))
     send_message(player, colourize(player.character.death_xp_loss(), "red"))
     if mob is not None:
-        send_info_message(f"{player.name} has died to {mob.name} at {player.current_room.name}!")
+        send_info_message(f"{player.name} has died to {mob.name} at {player.current_room.name}!", channel="deaths")
     else:
-        send_info_message(f"{player.name} has died at {player.current_room.name}!")
+        send_info_message(f"{player.name} has died at {player.current_room.name}!", channel="deaths")
     send_message(player, f"\n\nYou wake back up with a serious headache.\n")
            
     if not hasattr(player.character, 'death_room'):
@@ -69,6 +69,7 @@ def process_PC_death(player, mob=None):
     
     player.move_to_room(room_manager.get(player.character.death_room))
     player.character.current_hitpoints = player.character.max_hitpoints // 2
+    player.character.version += 1
 
 def deal_damage(attacker, defender, damage, msg, type=0):
     
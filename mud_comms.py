@@ -1,18 +1,68 @@
 # mud_comms.py
 
+import re
 import sys
-import socket
+import selectors
+from collections import Counter
+from functools import lru_cache
 
 
 # import local files
 import mud_password
 import mud_consts
 
-from mud_objects import Player, player_manager
+from mud_objects import Player, player_manager, persistence
+from mud_db import db_manager
+from mud_channels import channel_manager
+from mud_security import security_manager
 from mud_world import room_manager
 from mud_shared import log_info, log_error, colourize, first_to_upper, read_motd
 
+# Event loop selector (epoll on Linux), client sockets are registered once on
+# connect and unregistered on disconnect rather than rebuilt every loop
+selector = selectors.DefaultSelector()
 
+# Password checks waiting on mud_password's workers, by IP address
+password_checks = Counter()
+
+
+# Act-style messages, eg "$A hit$s $D for 5 damage!"
+#   $A - the actor, "you" to the actor
+#   $D - the target, "you" to the target
+#   $e, $s - verb endings, left off for the actor ("You miss", "Bob misses")
+act_token_re = re.compile(r'(\$[ADes])')
+leading_colour_codes_re = re.compile(r'(?:\033\[[\d;]*m)*')
+
+act_codes = {'$A': 0, '$D': 1, '$e': 2, '$s': 3}
+
+@lru_cache(maxsize=1024)
+def compile_act_message(msg):
+    """
+    Parses an act-style message into a format string, once per distinct message.
+
+    Literal text is capitalised at the start of each line here rather than every time the message
+    is sent. Each $ code becomes a positional field, {0}-{3} for $A, $D, $e, $s, or {4}-{7} for
+    a capitalised copy of the value when the code starts a line. See send_room_message_processing.
+    """
+    parts = []
+    line_start = True
+    for i, part in enumerate(act_token_re.split(msg)):
+        if i % 2:
+            parts.append("{%d}" % (act_codes[part] + (4 if line_start else 0)))
+            line_start = False
+            continue
+        lines = part.split('\n')
+        for j, line in enumerate(lines):
+            if j:
+                line_start = True
+            if line_start:
+                colour_codes = leading_colour_codes_re.match(line).group()
+                rest = line[len(colour_codes):]
+                if rest:
+                    lines[j] = colour_codes + rest[0].upper() + rest[1:]
+                    line_start = False
+        parts.append('\n'.join(lines).replace('{', '{{').replace('}', '}}'))
+    return ''.join(parts)
 
 def send_room_message_processing(player, target, msg):
     
@@ -24,26 +74,15 @@ def send_room_message_processing(player, target, msg):
         log_error(f"{player.name} has no room instance")
         return
     
-    
-    msg_to_player = msg
-    msg_to_player = msg_to_player.replace("$A", "you")
-    msg_to_player = msg_to_player.replace("$e", "")
-    msg_to_player = msg_to_player.replace("$s", "")
-    msg_to_player = msg_to_player.replace("$D", target_name)
-    msg_to_player = first_to_upper(msg_to_player)
-    
-    msg = msg.replace("$s", "s")
-    msg = msg.replace("$e", "e")
-    msg = msg.replace("$A", player.name)
-    
-    msg_to_room = msg
-    msg_to_room = msg_to_room.replace("$D", target_name)
-    msg_to_room = first_to_upper(msg_to_room)
+    # Values for $A, $D, $e, $s followed by their capitalised versions, for each viewer
+    template = compile_act_message(msg)
+    name, Name = player.name, player.name[:1].upper() + player.name[1:]
+    Target_name = target_name[:1].upper() + target_name[1:]
+    msg_to_player = template.format("you", target_name, "", "", "You", Target_name, "", "")
+    msg_to_room = template.format(name, target_name, "e", "s", Name, Target_name, "E", "S")
     
     if target is not None:
-        msg_to_target = msg
-        msg_to_target = msg_to_target.replace("$D", "you")
-        msg_to_target = first_to_upper(msg_to_target)
+        msg_to_target = template.format(name, "you", "e", "s", Name, "You", "E", "S")
         
         send_room_message(player.current_room, msg_to_room, [player, target], [msg_to_player, msg_to_target])
     else:
@@ -54,7 +93,7 @@ def send_room_message(room, msg, excluded_player=None, excluded_msg=None):
     """
     Sends a message to all players in a room, excluding specified players.
 
-    This function iterates over all players in the given room and sends them the message. 
+    The message goes to every awake player in the room through Room.broadcast, which encodes it once for all of them.
     If a player is in the excluded_player list, they receive the corresponding excluded_msg instead of the main message.
 
     Args:
@@ -75,25 +114,15 @@ def send_room_message(room, msg, excluded_player=None, excluded_msg=None):
         log_error("Room is None")
         return
     
-    for player in room.get_players():
-        if not player.character.is_awake() or player.character.NPC:
-            continue
-        if player not in excluded_player:
-            room_msg = msg
-            send_message(player, room_msg)
-        else:
-            if excluded_msg is not None:
-                index = excluded_player.index(player)
-                if index < len(excluded_msg):
-                    send_message(player, excluded_msg[index])
+    variants = {}
+    for index, player in enumerate(excluded_player):
+        # setdefault so a player listed twice (eg targeting themselves) gets their first message
+        variants.setdefault(player, excluded_msg[index] if excluded_msg is not None and index < len(excluded_msg) else None)
+    room.broadcast(msg, variants)
        
-def send_info_message(msg, InfoType="INFO", colour="red"):
-    send_global_message(colourize(f"[{InfoType}]: {msg}\n", colour))
+def send_info_message(msg, InfoType="INFO", colour="red", channel="info"):
+    channel_manager.get(channel).broadcast(colourize(f"[{InfoType}]: {msg}\n", colour))
              
-def send_global_message(msg):
-    for player in player_manager.get_players(LoggedIn=True):
-            send_message(player, msg)
-        
 def send_message(player, msg):
     """
     Sends a message to a specific player.
@@ -110,35 +139,95 @@ def send_message(player, msg):
     """
     if player.character is not None and player.character.NPC is True:
         return
-    player.output_buffer += msg
+    player.output_buffer.write(msg)
     
 def process_output(NewLineAtStart=True):
-    for player in player_manager.get_players(LoggedIn=False):
-        if player.output_buffer != "":
-            if player.loggedin:
+    """
+    Flushes the output buffer of each player with pending output, with a single write per player.
+
+    Text and GMCP frames are sent in the order they were queued, and players that are logged in
+    get their prompt after any text (GMCP on its own doesn't need a new prompt).
+    """
+    pending = player_manager.output_pending
+    while pending:
+        # Popped one at a time, a disconnection while sending can queue messages for other players
+        player = pending.pop()
+        if player.output_buffer.is_empty() or player_manager.get(player.socket) is not player:
+            continue
+        try:
+            add_prompt = player.output_buffer.has_text and player.loggedin
+            output = player.output_buffer.take()
+            if add_prompt:
                 if NewLineAtStart:
-                    player.output_buffer = "\n" + player.output_buffer
-                player.output_buffer += player.character.get_prompt()
-            try:
-                player.socket.sendall(player.output_buffer.encode('utf-8'))
-            except (BrokenPipeError, OSError):
-                handle_disconnection(player)
-            except socket.timeout:
-                log_error(f"Socket operation timed out for player {player.fd}")
-            except UnicodeEncodeError:
-                log_error(f"Failed to encode message for player {player.fd}")
-            except Exception as e:  # This will catch any other types of exceptions
-                log_error(f"Unexpected error while sending player output: {e}")
-            finally:
-                player.output_buffer = ""
+                    output[:0] = b"\n"
+                output += player.character.get_prompt().encode('utf-8')
+            queue_output(player, output)
+        except UnicodeEncodeError:
+            log_error(f"Failed to encode prompt for player {player.fd}")
+        except Exception as e:  # This will catch any other types of exceptions
+            log_error(f"Unexpected error while sending player output: {e}")
+
+def queue_output(player, data):
+    """
+    Adds encoded data to the player's outbound buffer and writes as much of it as the socket will take.
+
+    Whatever the client hasn't read yet stays in the buffer and is written when the selector
+    reports the socket writable again, rather than blocking the game loop in sendall.
+    A client that falls more than MAX_OUTPUT_BUFFER bytes behind is disconnected.
+
+    Args:
+        player (Player): The player to send the data to.
+        data (bytes): The data to be sent.
+
+    Returns:
+        None
+    """
+    player.outbound += data
+    if len(player.outbound) > mud_consts.MAX_OUTPUT_BUFFER:
+        log_error(f"Player {player.fd} has {len(player.outbound)} bytes of unsent output, disconnecting")
+        player.outbound.clear()
+        handle_disconnection(player, "Output buffer overflow")
+        return
+    if not player.write_pending:
+        write_output(player)
+
+def write_output(player):
+    """
+    Writes as much of the player's outbound buffer as the socket accepts without blocking.
+
+    The socket is only registered for EVENT_WRITE while there is output left over, so an
+    idle connection never wakes the game loop up.
+    """
+    if player.outbound:
+        try:
+            sent = player.socket.send(player.outbound)
+            del player.outbound[:sent]
+        except (BlockingIOError, InterruptedError):
+            pass # The client's receive window is full, try again when the socket is writable
+        except (BrokenPipeError, OSError):
+            player.outbound.clear()
+            handle_disconnection(player)
+            return
+    pending = len(player.outbound) > 0
+    if pending != player.write_pending:
+        player.write_pending = pending
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if pending else selectors.EVENT_READ
+        try:
+            selector.modify(player.socket, events, player)
+        except KeyError:
+            pass # Socket isn't registered (asyncio server mode, or already disconnected)
                 
 
               
 # Character login functions
 
-def handle_new_client(client_socket):
+def handle_new_client(client_socket, register=True, address=None):
     player = Player(client_socket.fileno(), client_socket)
+    player.address = address
     player_manager.add(client_socket, player)
+    if register:
+        # the asyncio server mode passes register=False as its event loop owns the socket
+        selector.register(client_socket, selectors.EVENT_READ, player)
 
     send_message(player, mud_consts.Greeting)
     
@@ -183,12 +272,49 @@ def handle_existing_player(player):
     send_message(player, "Welcome back, " + player.name + "!\n")
     send_message(player, "What is your password? ")
 
+def start_password_check(player, func, args, on_result):
+    """
+    Runs a password hash or check on mud_password's workers, then on_result(player, result) on the game thread.
+
+    The player's input waits in their command queue until the check is done. An IP with
+    MAX_PASSWORD_CHECKS_PER_IP checks already waiting has to try again, so one client can't
+    tie up every worker.
+    """
+    if password_checks[player.address] >= mud_consts.MAX_PASSWORD_CHECKS_PER_IP:
+        send_message(player, "Too many logins in progress from your address, please try again: ")
+        return
+    password_checks[player.address] += 1
+    player.password_pending = True
+    mud_password.submit(func, args, lambda future: finish_password_check(player, future, on_result))
+
+def finish_password_check(player, future, on_result):
+    password_checks[player.address] -= 1
+    if password_checks[player.address] <= 0:
+        del password_checks[player.address]
+    player.password_pending = False
+    if player_manager.get(player.socket) is not player:
+        return # Disconnected while waiting
+    try:
+        result = future.result()
+    except Exception as e:
+        log_error(f"Password check failed for {player.name}: {e}")
+        send_message(player, "Something went wrong, please try again: ")
+    else:
+        on_result(player, result)
+    if player.command_queue and player_manager.get(player.socket) is player:
+        player_manager.input_pending[player] = True
+
 def handle_reconnect_prompt(player, msg):
     stored_password = mud_password.load_password(player.name)
-    if mud_password.verify_password(stored_password, msg.strip()):
+    start_password_check(player, mud_password.verify_password, (stored_password, msg.strip()), handle_reconnect_password)
+
+def handle_reconnect_password(player, verified):
+    if verified:
         send_message(player, "This character is already connected. Do you wish to reconnect? (Y/N) ")
         player.reconnect_prompt = False
         player.awaiting_reconnect_confirmation = True
+    elif security_manager.login_failed(player.address):
+        handle_disconnection(player, "Too many failed logins, try again later.\n")
     else:
         send_message(player, "Invalid password.\n")
         send_message(player, "What is your password? ")
@@ -206,17 +332,31 @@ def handle_reconnect_confirmation(player, msg):
 def handle_password_verification(player, msg):
     stored_password = mud_password.load_password(player.name)
     if stored_password is None:
-        # Create a new character
-        mud_password.save_password(player.name, msg.strip())
-        player.awaiting_race = True
-        send_message(player, mud_consts.RACE_MSG)
-    elif mud_password.verify_password(stored_password, msg.strip()):
+        start_password_check(player, mud_password.hash_password, (msg.strip(),), handle_new_password)
+    else:
+        start_password_check(player, mud_password.verify_password, (stored_password, msg.strip()), handle_password_result)
+
+def handle_new_password(player, hashed_password):
+    if mud_password.load_password(player.name) is not None:
+        # Someone else created the character while the password was being hashed
+        send_message(player, "That name has just been taken! Please choose a different name: ")
+        player.name = None
+        return
+    # Create a new character
+    mud_password.store_password(player.name, hashed_password)
+    player.awaiting_race = True
+    send_message(player, mud_consts.RACE_MSG)
+
+def handle_password_result(player, verified):
+    if verified:
         # Check if player exists in PlayerDatabase
         if not player.save_exists():
             player.awaiting_race = True
             send_message(player, mud_consts.RACE_MSG)
         else:
             finish_login(player, "\nLogin successful!\n", f"{player.name} logged in.")
+    elif security_manager.login_failed(player.address):
+        handle_disconnection(player, "Too many failed logins, try again later.\n")
     else:
         send_message(player, "Incorrect password! Please try again: \n")
 
@@ -239,6 +379,7 @@ def handle_origin_set(player, msg):
         comp -= 1
         if mud_consts.ORIGINS[comp]:
             player.character.origin = mud_consts.ORIGINS[comp]
+            player.character.version += 1
             player.awaiting_origin = False
             finish_login(player, "Character created successfully!\n", f"New character created: {player.name}")
         else:
@@ -249,22 +390,17 @@ def handle_origin_set(player, msg):
         send_message(player, mud_consts.ORIGIN_MSG)
         return
 
-from mud_abilities import Abilities
-
 def finish_login(player, msg, log_msg):    
+    try:
+        player.load()
+    except Exception as e:
+        # Not logged in, so disconnecting doesn't save over the character that failed to load
+        log_error(f"finish_login(): error loading player {player.name}: {e}")
+        handle_disconnection(player, "Your character couldn't be loaded, please contact an immortal.\n")
+        return
     player.loggedin = True
     if player.awaiting_reconnect_confirmation is False:
         send_message(player, read_motd() + "\n")
-    player.load()
-    #DB Hack - when adding new things to character, use this to ensure all old characters get it:
-    if hasattr(player.character, 'alignment') == False:
-        log_info("finish_login(): adding alignment to player " + player.name)
-        player.character.alignment = 0
-    if hasattr(player.character, 'abilities') == False:
-        player.character.abilities = Abilities()
-        log_info("finish_login(): adding abilities to player " + player.name)
-
-    # #DB Hack end
     player.save()
     if player.character.race == '':
         log_error("finish_login(): why did a player make it here without a race?")
@@ -273,6 +409,7 @@ def finish_login(player, msg, log_msg):
     player.set_room(room)
     send_message(player, msg)
     log_info(log_msg)
+    channel_manager.login(player)
     send_info_message(f"{player.name} has entered the game.")
     send_room_message(player.current_room, colourize(f"\n{player.name} suddenly appears in the room.", "green"), excluded_player=player)
     del player.reconnect_prompt
@@ -287,9 +424,14 @@ def handle_disconnection(player, msg=""):
     log_info(f"{player.fd}: {player.name} disconnected: {msg}")
     if player.current_room is not None:
         player.current_room.remove_player(player)
-    if player_manager.disconnect_player(player, msg) and player.name != None:
+    channel_manager.logout(player)
+    if player_manager.disconnect_player(player, msg) and player.loggedin:
         send_info_message(f"{player.name} has left the game.")
         send_room_message(player.current_room, colourize(f"\n{player.name} has left the game.", "green"), player)
+    try:
+        selector.unregister(player.socket)
+    except (KeyError, ValueError):
+        pass # Socket was never registered or is already closed
     try:
         player.socket.close()
     except OSError:
@@ -303,5 +445,7 @@ def handle_shutdown(signum, frame):
     if signum:
         log_error("Received signal " + str(signum))
     player_manager.save_all_players()
+    persistence.flush(wait=True)
+    db_manager.close_all()
     sys.exit(0)
     
@@ -5,12 +5,45 @@ from enum import Enum
 SERVER_LOG = "log/server_log.txt"
 MOTD_FILE = "config/motd.txt"
 BANLIST = "config/banlist.txt"
+TEMPBANS = "config/tempbans.txt" # written by mud_security, not kept in git
 
 DATABASE_FOLDER = "database"
 USER_DATABASE = 'user_database.db'
 PLAYER_DATABASE = 'player_database.db'
 OBJECT_DATABASE = 'object_database.db'
 
+# Database tuning, see mud_db
+DB_TIMEOUT = 5.0 # seconds a connection waits for another's write lock before giving up
+DB_CACHE_SIZE_KB = 8 * 1024 # page cache per connection
+DB_MMAP_SIZE = 64 * 1024 * 1024 # bytes of each database file read through memory mapping
+DB_CACHED_STATEMENTS = 256 # prepared statements kept per connection
+
+# Connection input limits
+RECV_BUFFER_SIZE = 16384 # bytes read per recv, large enough to drain a pasted speedwalk in one call
+MAX_INPUT_LINE_LENGTH = 4096 # a partial line longer than this is discarded
+MAX_QUEUED_COMMANDS = 100 # commands beyond this waiting to be processed are discarded
+
+# Connection output limits
+MAX_OUTPUT_BUFFER = 1024 * 1024 # a client that falls this many bytes behind reading its output is disconnected
+
+# Rate limiting, per IP address, see mud_security
+CONNECT_RATE = 0.5 # connections per second allowed over time
+CONNECT_BURST = 10 # connections allowed at once
+LOGIN_FAILURE_RATE = 1 / 60 # wrong passwords per second allowed over time
+LOGIN_FAILURE_BURST = 5 # wrong passwords allowed at once
+TEMP_BAN_SECONDS = 15 * 60 # how long an IP that goes over either limit is banned for
+
+# Saving
+SAVE_INTERVAL = 5 # seconds between write-behind flushes of changed players and objects
+
+# Password hashing
+PASSWORD_WORKERS = 2 # threads hashing and checking passwords off the game thread
+MAX_PASSWORD_CHECKS_PER_IP = 2 # password checks one IP can have waiting on the workers at once
+
+# Command scheduling
+COMMANDS_PER_PULSE = 4 # commands each player can run per pass of the command queues
+WAIT_STATE_BEAT = 0.25 # seconds per beat of wait state (eg Spell.lag), as per diku/merc
+
 # move to config file later
 DISCORD_URL = "https://discord.gg/pzqYzzTh"
 DISCORD_APPLICATION_ID = "1198002700881756181"
@@ -67,6 +100,8 @@ Greeting = """
 DIRECTIONS = ["north", "east", "south", "west", "up", "down"]
 DIRECTIONS_REVERSE = ["south", "west", "north", "east", "down", "up"]
 
+POSITIONS = ["Sleep", "Rest", "Stand"] # lowest to highest, see Command.min_position in mud_handler
+
 
 RACE_MSG = """
 Please choose from one of the following races:
@@ -364,6 +399,16 @@ class RoomSectorType(BaseEnum):
     BEACH = 8
     AIR = 9
     DESERT = 10
+
+class RoomContents(BaseEnum):
+    PLAYERS = 0
+    MOBS = 1
+    OBJECTS = 2
+    DOORS = 3
+    EXTENDED_DESCRIPTIONS = 4
+
+# Default kinds for Room.search, anything that can be the target of an action
+ROOM_CHARACTERS = (RoomContents.PLAYERS, RoomContents.MOBS)
     
     
     
@@ -0,0 +1,56 @@
+# mud_db.py
+
+import sqlite3
+import threading
+
+from mud_consts import DATABASE_FOLDER, DB_TIMEOUT, DB_CACHE_SIZE_KB, DB_MMAP_SIZE, DB_CACHED_STATEMENTS
+from mud_shared import log_error
+
+# Applied to every connection. WAL lets the game thread read while the persistence writer thread
+# is committing, and with WAL synchronous=NORMAL only syncs at checkpoints rather than every commit.
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}",
+    f"PRAGMA mmap_size = {DB_MMAP_SIZE}",
+    "PRAGMA temp_store = MEMORY",
+)
+
+class DatabaseManager:
+    """
+    Opens and configures the connections to the user, player and object databases, so they
+    are all set up the same way in one place.
+
+    A connection should only be used by one thread at a time, so the databases open one for
+    reading on the game thread and another for the persistence writer thread.
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def connect(self, filename):
+        connection = sqlite3.connect(f"{self.folder}/{filename}", timeout=DB_TIMEOUT,
+                                     cached_statements=DB_CACHED_STATEMENTS, check_same_thread=False)
+        for pragma in PRAGMAS:
+            connection.execute(pragma)
+        with self.lock:
+            self.connections.append(connection)
+        return connection
+
+    def close_all(self):
+        """
+        Closes every connection, eg at shutdown once everything has been saved. Closing the last
+        connection to a database checkpoints its WAL file back into the database.
+        """
+        with self.lock:
+            connections = self.connections
+            self.connections = []
+        for connection in connections:
+            try:
+                connection.close()
+            except sqlite3.Error as e:
+                log_error(f"Error closing database connection: {e}")
+
+# Init Global database manager
+db_manager = DatabaseManager(DATABASE_FOLDER)
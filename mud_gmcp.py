@@ -1,8 +1,6 @@
-import queue
 import json
 
 from mud_shared import log_error, log_info
-from mud_comms import handle_disconnection
 from mud_consts import Exits, RoomSectorType, DISCORD_APPLICATION_ID, DISCORD_URL
 
 # Telnet constants - see https://tools.ietf.org/html/rfc854
@@ -22,10 +20,124 @@ TELNET_GMCP_ASK_SUPPORTED = TELNET_IAC + TELNET_DO + TELNET_GMCP
 TELNET_GMCP_MSG_START = TELNET_IAC + TELNET_SB + TELNET_GMCP
 TELNET_GMCP_MSG_END = TELNET_IAC + TELNET_SE
 
+# Longest subnegotiation payload we'll buffer before giving up on it
+TELNET_MAX_SB_LENGTH = 65536
+
+class TelnetParser:
+    """
+    Streaming telnet parser, one per connection.
+
+    Splits the bytes received from a client into plain text and telnet events in a single pass.
+    Commands can be mixed in with text, several can arrive in one recv and one can be split across
+    recvs - the parser keeps its state between calls to feed(). IAC IAC is passed through as a
+    literal 0xff byte.
+
+    Events are tuples of:
+        (TELNET_WILL / TELNET_WONT / TELNET_DO / TELNET_DONT, option)
+        (TELNET_SB, option, payload)
+    """
+    STATE_DATA = 0
+    STATE_IAC = 1
+    STATE_OPTION = 2
+    STATE_SB_OPTION = 3
+    STATE_SB_DATA = 4
+    STATE_SB_IAC = 5
+    STATE_SB_DISCARD = 6 # dropping an over long subnegotiation until its IAC SE
+    STATE_SB_DISCARD_IAC = 7
+
+    IAC = TELNET_IAC[0]
+    SB = TELNET_SB[0]
+    SE = TELNET_SE[0]
+    NEGOTIATION = frozenset((TELNET_WILL[0], TELNET_WONT[0], TELNET_DO[0], TELNET_DONT[0]))
+
+    def __init__(self):
+        self.state = self.STATE_DATA
+        self.command = None
+        self.sb_option = None
+        self.sb_data = bytearray()
+
+    def feed(self, data):
+        """
+        Parses the next chunk of data from the client.
+
+        Returns:
+            tuple: (text, events) where text is the bytes of plain text found and events is a list of telnet events.
+        """
+        text = bytearray()
+        events = []
+        i = 0
+        length = len(data)
+        while i < length:
+            if self.state == self.STATE_DATA:
+                # Copy everything up to the next IAC in one go
+                next_iac = data.find(TELNET_IAC, i)
+                if next_iac == -1:
+                    text += data[i:]
+                    break
+                text += data[i:next_iac]
+                self.state = self.STATE_IAC
+                i = next_iac + 1
+                continue
+
+            byte = data[i]
+            i += 1
+            if self.state == self.STATE_IAC:
+                if byte == self.IAC:
+                    text.append(byte) # escaped 0xff
+                    self.state = self.STATE_DATA
+                elif byte in self.NEGOTIATION:
+                    self.command = bytes((byte,))
+                    self.state = self.STATE_OPTION
+                elif byte == self.SB:
+                    self.state = self.STATE_SB_OPTION
+                else:
+                    self.state = self.STATE_DATA # NOP, GA etc, nothing to do
+            elif self.state == self.STATE_OPTION:
+                events.append((self.command, bytes((byte,))))
+                self.state = self.STATE_DATA
+            elif self.state == self.STATE_SB_OPTION:
+                self.sb_option = bytes((byte,))
+                self.sb_data.clear()
+                self.state = self.STATE_SB_DATA
+            elif self.state == self.STATE_SB_DATA:
+                # Copy everything up to the next IAC in one go
+                next_iac = data.find(TELNET_IAC, i - 1)
+                if next_iac == -1:
+                    self.sb_data += data[i - 1:]
+                    i = length
+                else:
+                    self.sb_data += data[i - 1:next_iac]
+                    self.state = self.STATE_SB_IAC
+                    i = next_iac + 1
+                if len(self.sb_data) > TELNET_MAX_SB_LENGTH:
+                    log_error(f"Telnet subnegotiation longer than {TELNET_MAX_SB_LENGTH} bytes, discarding")
+                    self.sb_data.clear()
+                    self.state = self.STATE_SB_DISCARD_IAC if self.state == self.STATE_SB_IAC else self.STATE_SB_DISCARD
+            elif self.state == self.STATE_SB_IAC:
+                if byte == self.SE:
+                    events.append((TELNET_SB, self.sb_option, bytes(self.sb_data)))
+                    self.sb_data.clear()
+                    self.state = self.STATE_DATA
+                else:
+                    if byte == self.IAC:
+                        self.sb_data.append(byte) # escaped 0xff inside the subnegotiation
+                    self.state = self.STATE_SB_DATA
+            elif self.state == self.STATE_SB_DISCARD:
+                # Skip everything up to the next IAC in one go
+                next_iac = data.find(TELNET_IAC, i - 1)
+                if next_iac == -1:
+                    i = length
+                else:
+                    self.state = self.STATE_SB_DISCARD_IAC
+                    i = next_iac + 1
+            elif self.state == self.STATE_SB_DISCARD_IAC:
+                # Only IAC SE ends the subnegotiation, the rest of it is never treated as text
+                self.state = self.STATE_DATA if byte == self.SE else self.STATE_SB_DISCARD
+        return bytes(text), events
+
 class PlayerGMCP:
     def __init__(self, player):
         self.player = player
-        self.output_queue = queue.Queue()
         self.gmcp = True
         
     def queue_message(self, package, message, data):
@@ -34,11 +146,12 @@ class PlayerGMCP:
             gmcp_msg = f"{package}.{message} {data_str}"
             gmcp_msg_bytes = gmcp_msg.encode('utf-8')
             telnet_cmd = TELNET_GMCP_MSG_START + gmcp_msg_bytes + TELNET_GMCP_MSG_END
-            self.output_queue.put(telnet_cmd)
+            # Queued alongside the player's text so process_output sends both in order, in one write
+            self.player.output_buffer.write_bytes(telnet_cmd)
         except UnicodeEncodeError:
-            log_error(f"Failed to encode message for player {self.fd}")
+            log_error(f"Failed to encode message for player {self.player.fd}")
         except Exception as e:  # This will catch any other types of exceptions
-            log_error(f"Unexpected error while adding GMCP message to output queue: {e}")
+            log_error(f"Unexpected error while adding GMCP message to output buffer: {e}")
         
     def update_status(self):
         if self.player.loggedin is False:
@@ -107,43 +220,56 @@ class PlayerGMCP:
         self.queue_message("Room", "Info", self.get_room_info())
         
       
-def handle_gmcp_negotiation(data, player):
-    # print("handle_telnet", str(data[:3]), TELNET_IAC + TELNET_WILL)
-    if data[:3] == TELNET_WILL_SUPPORT + TELNET_GMCP:  
+def handle_telnet_event(event, player):
+    """
+    Handles a telnet event from TelnetParser.feed().
+    """
+    if event[0] == TELNET_SB:
+        _, option, payload = event
+        if option == TELNET_GMCP:
+            handle_gmcp_message(payload, player)
+    else:
+        command, option = event
+        handle_gmcp_negotiation(command, option, player)
+
+def handle_gmcp_negotiation(command, option, player):
+    if option != TELNET_GMCP:
+        return # optional - check for out telnet options here
+
+    if command == TELNET_WILL:
         player.gmcp = PlayerGMCP(player)
         log_info(f"Player {player.fd} supports GMCP")
         player.gmcp.queue_message("External", "Discord.Info", {'inviteurl': DISCORD_URL, 'applicationid': DISCORD_APPLICATION_ID})
        
-    elif data[:3] == TELNET_WONT_SUPPORT + TELNET_GMCP:  
+    elif command == TELNET_WONT:
         player.gmcp = None
         log_info(f"Player {player.fd} does not support GMCP")
         
-    # optional - check for out telnet options here
-        
-def handle_gmcp_message(data, player):
-    # Remove the IAC SB GMCP IAC SE bytes from the start and end of the message
-    gmcp_msg = data[3:-2]
+def handle_gmcp_message(payload, player):
+    if player.gmcp is None:
+        return
 
     # Decode the message from bytes to a string
-    gmcp_msg_str = gmcp_msg.decode('utf-8')
+    gmcp_msg_str = payload.decode('utf-8', errors='replace')
 
-    # Split the GMCP message into parts
-    parts = gmcp_msg_str.split(' ', 2)
+    # Split the GMCP message into the package.message and its (optional) JSON data
+    parts = gmcp_msg_str.split(' ', 1)
     
-    try:
-        # Check if the first part contains a '.'
-        if '.' in parts[0]:
-            # Split the first part into package and message parts
-            package, message = parts[0].split('.', 1)
-    except ValueError:
-        package = None
-        message = None
+    if '.' not in parts[0]:
+        log_error(f"Invalid GMCP message from player {player.fd}: {gmcp_msg_str}")
         return
+    
+    # Split the first part into package and message parts
+    package, message = parts[0].split('.', 1)
 
     # If the message contains data, parse it
+    data = None
     if len(parts) == 2:
-        data = json.loads(parts[1])
-
+        try:
+            data = json.loads(parts[1])
+        except json.JSONDecodeError:
+            log_error(f"Invalid GMCP data from player {player.fd}: {parts[1]}")
+            return
 
     process_gmcp_message(player, package, message, data)
     
@@ -154,11 +280,9 @@ def process_gmcp_message(player, package, message, data):
         if message == "Ping":
             player.gmcp.queue_message("Core", "Ping", {})
         elif message == "Hello":
-            if data is not None:
-                if "client" in data:
-                    client = data["client"]
-                if "version" in data:
-                    version = data["version"]
+            if isinstance(data, dict):
+                client = data.get("client")
+                version = data.get("version")
                 log_info(f"Player {player.fd} is using {client} version {version}")
     elif package == "Char":
         if message == "Status" or message == "Vitals":
@@ -172,22 +296,4 @@ def process_gmcp_message(player, package, message, data):
 def process_gmcp_discord_message(player, message, data):
     if message == "Discord.Hello":
         log_info("Discord.Hello received")
-        player.queue_message("External", "Discord.Info", {'inviteurl': DISCORD_URL, 'applicationid': DISCORD_APPLICATION_ID})
-        
- 
-def send_gmcp_messages(players):
-    for player in players:
-        if player.gmcp:
-            while not player.gmcp.output_queue.empty():
-                try:
-                    # Get the next message from the queue
-                    msg = player.gmcp.output_queue.get()
-
-                    # Send the message
-                    player.socket.send(msg)
-                except (BrokenPipeError, OSError):
-                    handle_disconnection(player)
-                except Exception as e:  # This will catch any other types of exceptions
-                    log_error(f"Unexpected error while sending GMCP message: {e}")
-                    
-
+        player.gmcp.queue_message("External", "Discord.Info", {'inviteurl': DISCORD_URL, 'applicationid': DISCORD_APPLICATION_ID})
@@ -1,18 +1,18 @@
 # mud_handler.py
 from datetime import datetime
-import pickle
 import random
 
 import mud_consts
-from mud_consts import RoomFlags, ObjLocationType, ObjWearFlags
+from mud_consts import RoomFlags, RoomContents, ObjLocationType, ObjWearFlags
 from mud_comms import send_message, send_room_message, handle_disconnection
-from mud_shared import colourize, is_NPC, read_motd, first_to_upper, log_error, search_items, check_flag, parse_argument
+from mud_shared import colourize, is_NPC, read_motd, first_to_upper, log_error, search_indexes, check_flag, parse_argument
 
 from mud_world import room_manager
 from mud_objects import player_db, player_manager, combat_manager
+from mud_channels import channel_manager
 from mud_combat import kill_mob, attempt_flee
 from mud_spells import do_cast
-from mud_socials import handle_social, list_socials
+from mud_socials import handle_social, list_socials, SOCIALS
 from mud_abilities import ScrollsAndSpellbooks, AbilityType
 from mud_mprog import mprog_room_check
 
@@ -20,24 +20,48 @@ from mud_mprog import mprog_room_check
 def cast_command(player, argument):
     do_cast(player, argument)
     
+def channels_command(player, argument):
+    if argument == '':
+        send_message(player, "Channels:\n")
+        for channel in channel_manager.get_all():
+            state = "on" if channel.is_subscribed(player) else "off"
+            send_message(player, f"  {channel.name: <8} {state: <4} {channel.description}\n")
+        send_message(player, "Type channels <name> to turn a channel on or off.\n")
+        return
+    
+    channel = channel_manager.find(argument.split()[0])
+    if channel is None:
+        send_message(player, "There is no such channel.\n")
+        return
+    
+    if channel.is_subscribed(player):
+        channel_manager.mute(player, channel)
+        send_message(player, f"You turn the {channel.name} channel off.\n")
+    else:
+        channel_manager.unmute(player, channel)
+        send_message(player, f"You turn the {channel.name} channel on.\n")
+
 def chat_command(player, argument):
     if argument == '':
         send_message(player, "It's easier to chat when you say something.\n")
         return
     
-    for other_player in player_manager.get_players():
-        if other_player != player and other_player.loggedin:
-            msg = colourize(f"{player.name} chats '{argument}'\n", "cyan")
-            send_message(other_player, f"{msg}")
-        elif other_player == player:
-            msg = colourize(f"You chat '{argument}'\n", "cyan")
-            send_message(player, msg)
+    channel = channel_manager.get("chat")
+    if not channel.is_subscribed(player):
+        send_message(player, "You have the chat channel turned off.\n")
+        return
+    
+    send_message(player, colourize(f"You chat '{argument}'\n", "cyan"))
+    channel.broadcast(colourize(f"{player.name} chats '{argument}'\n", "cyan"), excluded_player=player)
             
 def cmds_command(player, argument):
     send_message(player, "Commands implemented:\n")
-    for cmds in commands:
+    for cmds in command_registry.get_names():
         send_message(player, f"{cmds}\n")
         
+def is_container(object):
+    return object.is_container()
+
 def drop_object(player, object, target=None):
     # if object.is_droppable() == False:
     # etc
@@ -47,15 +71,11 @@ def drop_object(player, object, target=None):
     send_room_message(player.current_room, f"{player.name} drops {object.name}.\n", excluded_player=player)
     
 def drop_command(player, argument):
-    if player.character.get_position() == "Sleep":
-        send_message(player, "You are sleeping!\n")
-        return
-    
     if not argument:
         send_message(player, "Drop what?\n")
         return
 
-    process_items(player, None, argument, drop_object, player.get_objects())
+    process_items(player, None, argument, drop_object, player.inventory.index)
 
 def flee_command(player, argument):
     if combat_manager.in_combat(player) == False:
@@ -98,7 +118,7 @@ def follow_command(player, argument):
             player.follow = None
             return
 
-    target = search_items((player.current_room.get_players() | player.current_room.get_mobs()), argument)
+    target = player.current_room.search(argument)
     if target is not None:
         if target.follow is not None:
             send_message(player, f"{target.name} is already following someone.\n")
@@ -127,20 +147,19 @@ def get_object(player, object, target=None):
     send_room_message(player.current_room, f"{player.name} gets {object.name}.\n", excluded_player=player)
 
 def get_command(player, argument):
-    if player.character.get_position() == "Sleep":
-        send_message(player, "You are sleeping!\n")
-        return
-    
     if not argument:
         send_message(player, "Get what?\n")
         return
     
     item_name, target_name = parse_argument(argument.lower())
-    target = search_items((player.get_containers() | player.current_room.get_containers()), target_name)
     if target_name is not None:
-        process_items(player, target, item_name, get_object, target.get_objects())
+        target = search_indexes([player.inventory.index, player.current_room.object_index], target_name, is_container)
+        if target is None:
+            send_message(player, "You don't see that container here.\n")
+            return
+        process_items(player, target, item_name, get_object, target.inventory.index)
     else: # picking up from ground
-        process_items(player, None, item_name, get_object, player.current_room.get_objects())       
+        process_items(player, None, item_name, get_object, player.current_room.object_index)       
    
 
 def give_object(player, object, target):
@@ -148,20 +167,16 @@ def give_object(player, object, target):
     object.give(player, target)   
         
 def give_command(player, argument):
-    if player.character.get_position() == "Sleep":
-        send_message(player, "You are sleeping!\n")
-        return
-    
     if not argument:
         send_message(player, "Give what?\n")
         return
     
     item_name, target_name = parse_argument(argument.lower())
-    target = search_items((player.current_room.get_players() | player.current_room.get_mobs()), target_name)
+    target = player.current_room.search(target_name)
     if target is None:
         send_message(player, "There's no one here with that name.\n")
         return
-    process_items(player, target, item_name, give_object, player.get_objects())
+    process_items(player, target, item_name, give_object, player.inventory.index)
 
 
     
@@ -203,7 +218,7 @@ def kill_command(player, argument):
         send_message(player, "You need to be standing first!\n")
         return 
     
-    mob = search_items(player.current_room.get_mobs(), argument)
+    mob = player.current_room.search(argument, (RoomContents.MOBS,))
 
     if mob is None:
         send_message(player, "No mob with that name found.\n")
@@ -215,15 +230,14 @@ def last_command(player, argument):
         send_message(player, "You must specify a player name.\n")
         return
     
-    result = player_db.query_player(player.name, ["created", "lastlogin", "character"])
+    result = player_db.query_player(argument, ["created", "lastlogin", "level", "race"])
     if result is None:
         send_message(player, f"No player with the name {argument} found.\n")
         return
     
-    created, lastlogin, character = result
+    created, lastlogin, level, race = result
     created = datetime.strptime(created, '%Y-%m-%d %H:%M:%S.%f')
     lastlogin = datetime.strptime(lastlogin, '%Y-%m-%d %H:%M:%S.%f')
-    character = pickle.loads(character)
     
     today = datetime.now().date()
     if created.date() == today:
@@ -236,10 +250,10 @@ def last_command(player, argument):
     else:
         formatted_lastlogin = lastlogin.strftime("%B %d, %Y")
         
-    if hasattr(character, 'level') is False or hasattr(character, 'race') is False:
+    if level is None or race is None:
         log_error(f"last_command: {argument} has no character level or race")
     else:    
-        send_message(player, f"{first_to_upper(argument)} is a level {character.level} {character.race} ")
+        send_message(player, f"{first_to_upper(argument)} is a level {level} {race} ")
         
     send_message(player, f"created {formatted_created} and last logged in {formatted_lastlogin}\n")
 
@@ -280,7 +294,7 @@ def look_command(player, argument):
         
         keyword = argument.split()[1]
         
-        object = search_items(room.get_containers() | player.get_containers(), keyword)
+        object = search_indexes([room.object_index, player.inventory.index], keyword, is_container)
         
         if object is None:
             send_message(player, "No object with that name found.\n")
@@ -303,11 +317,9 @@ def look_command(player, argument):
     
     
     
-    # Create a list of all items in the room and in the player's inventory
-    all_items = (room.get_players() | player.get_objects() | room.get_mobs() | room.get_objects() | room.get_doors() | room.get_extended_descriptions())
-
-    # Search for the item in the list of all items
-    item = search_items(all_items, argument)
+    # Search everything in the room and in the player's inventory
+    all_items = [room.player_index, player.inventory.index, room.mob_index, room.object_index, room.door_index, room.extended_description_index]
+    item = search_indexes(all_items, argument)
     if item is not None:
         send_message(player, f"{item.get_description()}\n")
         return
@@ -321,21 +333,18 @@ def put_object(player, object, target):
 
 
 def put_command(player, argument):
-    if player.character.get_position() == "Sleep":
-        send_message(player, "You are sleeping!\n")
-        return
-    
     if not argument:
         send_message(player, "Put what?\n")
         return
     
     item_name, target_name = parse_argument(argument.lower())
-    target = search_items((player.get_containers() | player.current_room.get_containers()), target_name)
+    target = search_indexes([player.inventory.index, player.current_room.object_index], target_name, is_container)
     
     if target is None:
         send_message(player, "Put it where?\n")
+        return
 
-    process_items(player, target, item_name, put_object, player.get_objects())
+    process_items(player, target, item_name, put_object, player.inventory.index)
         
 
 def quit_command(player, argument):
@@ -474,7 +483,7 @@ def study_command(player, argument):
         send_message(player, colourize("You fumble groggily with the scroll, but your drowsy mind cannot comprehend the mystical runes. The words blur before your eyes as you drift back into the comforting embrace of sleep, the knowledge of the scroll remaining just out of reach in your slumbering state.\n", "green"))
         return
     
-    object = search_items(player.get_objects(), argument.lower())
+    object = player.inventory.search(argument.lower())
         
     if object is None:
         send_message(player, "No scroll or spellbook with that name found.\n")
@@ -503,7 +512,7 @@ def title_command(player, argument):
         return
     
     if argument.split()[0].lower() == 'reset':
-        player.title = "the" + player.character.origin
+        player.set_title("the" + player.character.origin)
         send_message(player, "Your title has been reset.\n")
         return
     
@@ -542,7 +551,7 @@ def wield_command(player, argument):
     
     item_name, _ = parse_argument(argument.lower())
     
-    object = search_items(player.get_objects(), item_name)
+    object = player.inventory.search(item_name)
     
     if object is None:
         send_message(player, "No object with that name found.\n")
@@ -576,7 +585,7 @@ def player_movement(player, direction):
             if room_instance.doors[direction]["locks"] == 0:
                 move_player(player, room_instance.vnum, room_instance.doors[direction]["to_room"], msg_to_room=colourize(f"{first_to_upper(player.name)} leaves to the {mud_consts.DIRECTIONS[direction]}.\n", "green"))
                 send_room_message(room_manager.get(room_instance.doors[direction]["to_room"]) , colourize(f"{first_to_upper(player.name)} arrives from the {mud_consts.DIRECTIONS_REVERSE[direction]}.\n", "green"), excluded_player=player)
-                for other_player in set(room_instance.get_players()):
+                for other_player in list(room_instance.get_players()):
                     if other_player.follow == player:
                         send_message(other_player, f"You follow {player.name} {mud_consts.DIRECTIONS[direction]}.\n")
                         player_movement(other_player, direction)                            
@@ -608,47 +617,146 @@ def down_command(player, argument):
 def test_command(player, argument):
     pass
 
-commands = {
-    'cast': [cast_command],
-    'chat' : [chat_command],
-    'cmds' : [cmds_command],
-    'drop': [drop_command],
-    'down': [down_command],
-    'east': [east_command],
-    'flee': [flee_command],
-    'follow': [follow_command],
-    'get': [get_command],
-    'give': [give_command],
-    'goto': [goto_command],
-    'inventory' : [inventory_command],
-    'kill': [kill_command],
-    'last': [last_command],
-    'look': [look_command],
-    'motd': [lambda player, argument: send_message(player, read_motd() + "\n")],
-    'north': [north_command],
-    'put': [put_command],
-    'quit': [quit_command],
-    'recall': [recall_command],
-    'rest': [rest_command],
-    'save': [save_command],
-    'say': [say_command],
-    'scan': [scan_command],
-    'score': [score_command],
-    'sleep': [sleep_command],
-    'socials': [list_socials],
-    'south': [south_command],
-    'stand': [stand_command],
-    'study': [study_command],
-    'test':[test_command],
-    'title':[title_command],
-    'up': [up_command],
-    'wake': [stand_command],
-    'west': [west_command],
-    'wield': [wield_command],
-    'who': [who_command],
-    # Add more commands here...
-}
+class Command:
+    """
+    A command a player can type, with the requirements that are checked before it runs.
+
+    Args:
+        name (str): The full name of the command.
+        func (function): Called with (player, argument).
+        full_word_only (bool): The command must be typed in full, eg quit.
+        min_position (str): The lowest position (see mud_consts.POSITIONS) the command can be used in.
+        min_level (int): The lowest level that can use the command.
+        position_msg (str): Sent when the player's position is too low.
+    """
+    def __init__(self, name, func, full_word_only=False, min_position=None, min_level=0, position_msg="You are sleeping!\n"):
+        self.name = name
+        self.func = func
+        self.full_word_only = full_word_only
+        self.min_position = min_position
+        self.min_level = min_level
+        self.position_msg = position_msg
+
+    def run(self, player, argument):
+        if player.character.level < self.min_level:
+            send_message(player, "I'm sorry, I don't understand you.\n")
+            return
+        if self.min_position is not None and mud_consts.POSITIONS.index(player.character.get_position()) < mud_consts.POSITIONS.index(self.min_position):
+            send_message(player, self.position_msg)
+            return
+        self.func(player, argument)
+
+class CommandRegistry:
+    """
+    Commands, shortcuts and socials, with every abbreviation a player can type worked out once,
+    the first time a command is looked up after registering, so finding a command is a single dict lookup.
 
+    When an abbreviation matches more than one thing the winner is, highest first:
+    a shortcut (eg 'n' for north), a command's full name, the first registered command the
+    abbreviation is a prefix of, then a social (socials have to be typed in full).
+    """
+    def __init__(self):
+        self.commands = {} # name -> Command, in the order registered
+        self.shortcuts = {} # shortcut -> command name
+        self.socials = {} # social name -> Command
+        self.lookup = None # everything that can be typed -> Command, None until built by find
+
+    def register(self, name, func, **kwargs):
+        self.commands[name] = Command(name, func, **kwargs)
+        self.lookup = None
+
+    def add_shortcut(self, shortcut, name):
+        self.shortcuts[shortcut] = name
+        self.lookup = None
+
+    def add_social(self, name, func):
+        self.socials[name] = Command(name, func, full_word_only=True)
+        self.lookup = None
+
+    def build_lookup(self):
+        lookup = {}
+        for name, command in self.commands.items():
+            for length in range(1, len(name)):
+                lookup.setdefault(name[:length], command)
+        for name, command in self.commands.items():
+            lookup[name] = command
+        for shortcut, name in self.shortcuts.items():
+            lookup[shortcut] = self.commands[name]
+        for name, command in self.socials.items():
+            lookup.setdefault(name, command)
+        self.lookup = lookup
+
+    def find(self, command):
+        if self.lookup is None:
+            self.build_lookup()
+        return self.lookup.get(command)
+
+    def get_names(self):
+        return self.commands.keys()
+
+def run_social(name):
+    def social_command(player, argument):
+        handle_social(player, name, argument)
+    return social_command
+
+command_registry = CommandRegistry()
+command_registry.register('cast', cast_command)
+command_registry.register('chat', chat_command)
+command_registry.register('channels', channels_command)
+command_registry.register('cmds', cmds_command)
+command_registry.register('drop', drop_command, min_position="Rest")
+command_registry.register('down', down_command)
+command_registry.register('east', east_command)
+command_registry.register('flee', flee_command)
+command_registry.register('follow', follow_command)
+command_registry.register('get', get_command, min_position="Rest")
+command_registry.register('give', give_command, min_position="Rest")
+command_registry.register('goto', goto_command)
+command_registry.register('inventory', inventory_command)
+command_registry.register('kill', kill_command)
+command_registry.register('last', last_command)
+command_registry.register('look', look_command)
+command_registry.register('motd', lambda player, argument: send_message(player, read_motd() + "\n"))
+command_registry.register('north', north_command)
+command_registry.register('put', put_command, min_position="Rest")
+command_registry.register('quit', quit_command, full_word_only=True)
+command_registry.register('recall', recall_command)
+command_registry.register('rest', rest_command)
+command_registry.register('save', save_command)
+command_registry.register('say', say_command)
+command_registry.register('scan', scan_command)
+command_registry.register('score', score_command)
+command_registry.register('sleep', sleep_command)
+command_registry.register('socials', list_socials)
+command_registry.register('south', south_command)
+command_registry.register('stand', stand_command)
+command_registry.register('study', study_command)
+command_registry.register('test', test_command)
+command_registry.register('title', title_command)
+command_registry.register('up', up_command)
+command_registry.register('wake', stand_command)
+command_registry.register('west', west_command)
+command_registry.register('wield', wield_command)
+command_registry.register('who', who_command)
+# Add more commands here...
+
+command_registry.add_shortcut('n', 'north')
+command_registry.add_shortcut('e', 'east')
+command_registry.add_shortcut('s', 'south')
+command_registry.add_shortcut('w', 'west')
+command_registry.add_shortcut('u', 'up')
+command_registry.add_shortcut('d', 'down')
+command_registry.add_shortcut('l', 'look')
+command_registry.add_shortcut('i', 'inventory')
+command_registry.add_shortcut('c', 'cast')
+command_registry.add_shortcut('st', 'stand')
+command_registry.add_shortcut('sc', 'score')
+command_registry.add_shortcut('j', 'scan')
+command_registry.add_shortcut('x', 'scan')
+# Add more shortcuts here...
+
+for social in SOCIALS:
+    command_registry.add_social(social, run_social(social))
 
 def handle_player(player, msg):
     # Strip the msg of whitespace and newlines then split into command and argument
@@ -660,55 +768,16 @@ def handle_player(player, msg):
     if msg == '':
         return
 
-    # Define command shortcuts
-    shortcuts = {
-        'n': 'north',
-        'e': 'east',
-        's': 'south',
-        'w': 'west',
-        'u': 'up',
-        'd': 'down',
-        'l': 'look',
-        'i': 'inventory',
-        'c': 'cast',
-        'st': 'stand',
-        'sc': 'score',
-        'j': 'scan',
-        'x': 'scan',
-        
-        # Add more shortcuts here...
-    }
-
-    # Define full commands
-    full_commands = {'quit'}
-
-    # Get the command function
-    if command in shortcuts:
-        command_func = commands[shortcuts[command]][0]
-    elif command in full_commands:
-        command_func = commands[command][0] if command in commands else None
-    else:
-        # Find the first command that starts with the command entered by the player
-        matches = [cmd for cmd in commands if cmd.startswith(command)]
-        if matches:
-            if matches[0] in full_commands:
-                send_message(player, f"You need to type the full command '{matches[0]}' for it to work.\n")
-                return
-            command_func = commands[matches[0]][0]
-        else:
-            command_func = None
-
-    # If the command exists, execute it
-    if command_func:
-        command_func(player, argument)
+    command_entry = command_registry.find(command)
+    if command_entry is None:
+        send_message(player, "I'm sorry, I don't understand you.\n")
         return
-    else:
-        social_check = handle_social(player, command, argument)
-        if social_check:
-            return
-        else:   
-            send_message(player, "I'm sorry, I don't understand you.\n")
-            return
+    
+    if command_entry.full_word_only and command != command_entry.name:
+        send_message(player, f"You need to type the full command '{command_entry.name}' for it to work.\n")
+        return
+
+    command_entry.run(player, argument)
         
 def move_player(player, old_room_vnum, new_room_vnum, msg_to_room=None, msg_to_player=None):
     """move player from old_room to new_room, use room vnums"""
@@ -729,7 +798,7 @@ def move_player(player, old_room_vnum, new_room_vnum, msg_to_room=None, msg_to_p
     
     mprog_room_check(player)
     
-def process_items(player, target, item_name, action, search_item_set):
+def process_items(player, target, item_name, action, search_index):
     """
     Processes items in the player's inventory based on the provided action.
 
@@ -742,29 +811,30 @@ def process_items(player, target, item_name, action, search_item_set):
     target (Player or Mob): The target of the action. This can be another player, a mob, or None.
     item_name (str): The name of the item(s) to process. This can be 'all', 'all.item_name', or a specific item name.
     action (function): The action to perform. This should be a function that takes a player, an item, and a target as parameters.
+    search_index (KeywordIndex): The items to choose from, eg player.inventory.index or room.object_index.
 
     Returns:
     None
     """
     if item_name == 'all':
-        if len(search_item_set) == 0:
+        if len(search_index) == 0:
             send_message(player, "You are not carrying anything.\n")
             return
-        for object in list(search_item_set):
+        for object in list(search_index):
             action(player, object, target)
     elif item_name.startswith('all.'):
         if len(item_name) == 4:
             send_message(player, "Give what to whom?\n")
             return
-        object_list = [item for item in search_item_set if any(kw.startswith(item_name[4:]) for kw in item.get_keywords())]
+        object_list = search_index.matches(item_name[4:])
         if not object_list:
             send_message(player, "You are not carrying anything with that name.\n")
             return
         for object in object_list:
             action(player, object, target)
     else:
-        object = search_items(search_item_set, item_name)
+        object = search_indexes([search_index], item_name)
         if object is None:
             send_message(player, "No item with that name found.\n")
             return
-        action(player, object, target)
\ No newline at end of file
+        action(player, object, target)
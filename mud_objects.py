@@ -2,7 +2,9 @@
 
 import sqlite3
 import threading
+import queue
 import pickle
+from collections import deque, Counter
 from datetime import datetime
 import time
 import random
@@ -10,15 +12,39 @@ import uuid
 import json
 from enum import Enum
 
-from mud_shared import dice_roll, colourize, log_info, log_error, check_flag, first_to_upper, process_keyword, process_search_output
+from mud_shared import dice_roll, colourize, log_info, log_error, check_flag, first_to_upper, KeywordIndex, search_indexes, intern_keywords
 import mud_consts
-from mud_consts import Exits, ObjType, ObjWearFlags, ObjState, ObjLocationType, MobActFlags, RoomFlags, RoomSectorType, EquipSlots, get_equip_slot
+from mud_db import db_manager
+from mud_consts import Exits, ObjType, ObjWearFlags, ObjState, ObjLocationType, MobActFlags, RoomFlags, RoomSectorType, RoomContents, ROOM_CHARACTERS, EquipSlots, get_equip_slot
 from mud_abilities import Abilities
 
+# Version of the JSON in the players table's character and equipment columns. To change the format,
+# bump PLAYER_SCHEMA_VERSION and add a function to PLAYER_SCHEMA_MIGRATIONS, keyed on the old version,
+# that takes the old (character, equipment) dicts and returns them in the new format.
+PLAYER_SCHEMA_VERSION = 1
+PLAYER_SCHEMA_MIGRATIONS = {}
+
+def upgrade_player_data(schema_version, character_data, equipment_data):
+    while schema_version < PLAYER_SCHEMA_VERSION:
+        character_data, equipment_data = PLAYER_SCHEMA_MIGRATIONS[schema_version](character_data, equipment_data)
+        schema_version += 1
+    return character_data, equipment_data
+
 class PlayerDatabase:
+    # Columns added since the table was first created, added to older databases on startup
+    added_columns = (
+        ('level', 'INTEGER'),
+        ('race', 'TEXT'),
+        ('xp', 'INTEGER'),
+        ('gold', 'INTEGER'),
+        ('schema_version', 'INTEGER'),
+    )
+
     def __init__(self, db_name):
-        self.connection = sqlite3.connect(db_name, check_same_thread=False)
+        self.connection = db_manager.connect(db_name) # reads, on the game thread
+        self.write_connection = db_manager.connect(db_name) # writes, on the persistence writer thread
         self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
         self.cursor = self.connection.cursor()
         self.cursor.execute('''
             CREATE TABLE IF NOT EXISTS players (
@@ -31,45 +57,110 @@ class PlayerDatabase:
                 character BLOB,
                 inventory TEXT,
                 equipment BLOB,
-                abilities BLOB
+                abilities BLOB,
+                level INTEGER,
+                race TEXT,
+                xp INTEGER,
+                gold INTEGER,
+                schema_version INTEGER
             )
         ''')
         self.connection.commit()
+        self.add_columns()
+        self.normalise_names()
+        self.migrate_pickled_players()
 
-    def save_player(self, player):
-        with self.lock:
-            
-            if player.name is None or player.name == "":
-                log_error("Player_DB: Error saving player, player name is None or empty")
-                return
-            
-            player_name = player.name.lower()
-            character_data = pickle.dumps(player.character)
-            inventory_data = json.dumps([str(i) for i in player.inventory.uuids])
-            equipment_data = pickle.dumps(player.equipment)
-            # abilities_data = pickle.dumps(player.abilities)
-            abilities_data = None
+    def normalise_names(self):
+        """
+        Lower cases any names saved before names were always lower cased on write, so players
+        can be looked up by the primary key with name = ? instead of scanning with LOWER(name).
+        """
+        self.cursor.execute('UPDATE OR IGNORE players SET name = LOWER(name) WHERE name != LOWER(name)')
+        if self.cursor.rowcount > 0:
+            log_info(f"Player_DB: lower cased {self.cursor.rowcount} player names")
+        self.cursor.execute('SELECT name FROM players WHERE name != LOWER(name)')
+        for (name,) in self.cursor.fetchall():
+            log_error(f"Player_DB: {name} clashes with another player's name when lower cased")
+        # Superseded by the primary key
+        self.cursor.execute('DROP INDEX IF EXISTS players_name_lower')
+        self.connection.commit()
+
+    def add_columns(self):
+        existing_columns = {row[1] for row in self.cursor.execute('PRAGMA table_info(players)')}
+        for column, column_type in self.added_columns:
+            if column not in existing_columns:
+                self.cursor.execute(f'ALTER TABLE players ADD COLUMN {column} {column_type}')
+        self.connection.commit()
+
+    def migrate_pickled_players(self):
+        """
+        Rewrites players saved as pickles, before the JSON format, so their level etc. columns are filled in.
+        """
+        self.cursor.execute('SELECT name, character, equipment FROM players WHERE schema_version IS NULL')
+        rows = self.cursor.fetchall()
+        for name, character_data, equipment_data in rows:
+            try:
+                character, equipment = self.decode_player(None, character_data, equipment_data)
+            except Exception as e:
+                log_error(f"Player_DB: Error converting pickled player {name}: {e}")
+                continue
             self.cursor.execute('''
-                INSERT OR REPLACE INTO players (name, room_id, current_recall, created, lastlogin, title, character, inventory, equipment, abilities)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (player_name, player.room_id, player.current_recall, player.created, player.lastlogin, player.title, character_data, inventory_data, equipment_data, abilities_data))
+                UPDATE players SET character = ?, equipment = ?, level = ?, race = ?, xp = ?, gold = ?, schema_version = ? WHERE name = ?
+            ''', (json.dumps(character.to_dict()), json.dumps(equipment.to_dict()), character.level, character.race, character.xp, character.gold, PLAYER_SCHEMA_VERSION, name))
+        if rows:
             self.connection.commit()
+            log_info(f"Player_DB: converted {len(rows)} pickled players")
+
+    def decode_player(self, schema_version, character_data, equipment_data):
+        """
+        Returns the Character and Equipment saved in a row, upgrading them from older formats if needed.
+        """
+        if schema_version is None:
+            # Pickled, going through to_dict/from_dict fills in anything added to the classes since
+            character = Character.from_dict(pickle.loads(character_data).to_dict())
+            equipment = Equipment.from_dict(pickle.loads(equipment_data).to_dict())
+            return character, equipment
+        character_dict, equipment_dict = upgrade_player_data(schema_version, json.loads(character_data), json.loads(equipment_data))
+        return Character.from_dict(character_dict), Equipment.from_dict(equipment_dict)
+
+    def player_row(self, player):
+        """
+        Returns the row save_players writes for a player, taken on the game thread so the
+        writer thread never sees a player half way through a change.
+        """
+        player_name = player.name.lower()
+        character = player.character
+        character_data = json.dumps(character.to_dict())
+        inventory_data = json.dumps([str(i) for i in player.inventory.uuids])
+        equipment_data = json.dumps(player.equipment.to_dict())
+        # abilities are saved as part of the character
+        abilities_data = None
+        return (player_name, player.room_id, player.current_recall, player.created, player.lastlogin, player.title, character_data, inventory_data, equipment_data, abilities_data,
+                character.level, character.race, character.xp, character.gold, PLAYER_SCHEMA_VERSION)
+
+    def save_players(self, rows):
+        # One transaction for all the rows, on the persistence writer thread, see PersistenceService
+        with self.write_lock:
+            self.write_connection.executemany('''
+                INSERT OR REPLACE INTO players (name, room_id, current_recall, created, lastlogin, title, character, inventory, equipment, abilities, level, race, xp, gold, schema_version)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+            self.write_connection.commit()
 
 
     def load_player(self, name):
         with self.lock:
             self.cursor.execute('''
-            SELECT room_id, current_recall, created, lastlogin, title, character, inventory, equipment, abilities FROM players WHERE LOWER(name) = LOWER(?)
+            SELECT room_id, current_recall, created, lastlogin, title, character, inventory, equipment, abilities, schema_version FROM players WHERE name = ?
             ''', (name.lower(),))
             result = self.cursor.fetchone()
             if result is None:
                 log_error(f"Error loading player data for {name}")
                 return None
             else:
-                room_id, current_recall, created, lastlogin, title, character_data, inventory_data, equipment_data, abilities_data = result
-                character = pickle.loads(character_data)
+                room_id, current_recall, created, lastlogin, title, character_data, inventory_data, equipment_data, abilities_data, schema_version = result
+                character, equipment = self.decode_player(schema_version, character_data, equipment_data)
                 inventory = set(uuid.UUID(i) for i in json.loads(inventory_data)) if inventory_data is not None else set()
-                equipment = pickle.loads(equipment_data)
                 # abilities = pickle.loads(abilities_data)
                 abilities = None
                 return {
@@ -85,10 +176,15 @@ class PlayerDatabase:
                 'abilities' : abilities
                 }
     
+    def player_exists(self, name):
+        with self.lock:
+            self.cursor.execute('SELECT EXISTS (SELECT 1 FROM players WHERE name = ?)', (name.lower(),))
+            return self.cursor.fetchone()[0] == 1
+
     def get_player_created_lastlogin(self, name):
         with self.lock:
             self.cursor.execute('''
-                SELECT created, lastlogin FROM players WHERE LOWER(name) = LOWER(?)
+                SELECT created, lastlogin FROM players WHERE name = ?
             ''', (name.lower(),))
             result = self.cursor.fetchone()
             if result is None:
@@ -112,7 +208,7 @@ class PlayerDatabase:
         with self.lock:
             try:
                 # Construct the SQL query
-                sql = 'SELECT {} FROM players WHERE LOWER(name) = LOWER(?)'.format(', '.join(fields))
+                sql = 'SELECT {} FROM players WHERE name = ?'.format(', '.join(fields))
                 self.cursor.execute(sql, (player_name.lower(),))
 
                 result = self.cursor.fetchone()
@@ -126,7 +222,10 @@ class PlayerDatabase:
         
 class ObjectDatabase:
     def __init__(self, db_path):
-        self.conn = sqlite3.connect(db_path)
+        self.conn = db_manager.connect(db_path) # reads, on the game thread
+        self.write_conn = db_manager.connect(db_path) # writes, on the persistence writer thread
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
         self.cursor = self.conn.cursor()
         self.create_table()
 
@@ -147,16 +246,20 @@ class ObjectDatabase:
                 enchantments TEXT
             )
         """)
+        self.conn.commit()
 
-    def save_object(self, obj):
-        self.cursor.execute("""
-            INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
+    def object_row(self, obj):
+        """
+        Returns the row write_objects writes for an object, taken on the game thread.
+
+        Descriptions the same as the template's are saved as None and filled in from the template on load.
+        """
+        return (
             str(obj.uuid),
             obj.vnum,
-            obj.name,
-            obj.desc,
-            obj.action_desc,
+            obj.name if obj.name != obj.template.short_desc else None,
+            obj.desc if obj.desc != obj.template.long_desc else None,
+            obj.action_desc if obj.action_desc != obj.template.action_desc else None,
             obj.state.value,
             obj.insured,
             obj.location,
@@ -164,30 +267,33 @@ class ObjectDatabase:
             obj.max_hitpoints,
             obj.current_hitpoints,
             json.dumps(obj.enchantments)
-        ))
-        self.conn.commit()
-        log_info(f"Saved object {obj.name} {obj.uuid} to database")
-        
-    def save_objects(self, objects):
+        )
+
+    def write_objects(self, rows, deleted_uuids=()):
+        """
+        Saves object rows and deletes objects by uuid, in one transaction, on the persistence writer thread.
+        """
         if self.conn is None:
             log_error("Object DB Error: Database connection is not open")
             return
 
-        data = [(str(obj.uuid), obj.vnum, obj.name, obj.desc, obj.action_desc, obj.state.value, obj.insured, obj.location, obj.location_type.name, obj.max_hitpoints, obj.current_hitpoints, json.dumps(obj.enchantments)) for obj in objects]
-
-        self.cursor.executemany("""
-            INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, data)
-
-        self.conn.commit()
+        with self.write_lock:
+            self.write_conn.executemany("""
+                INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, rows)
+            self.write_conn.executemany("""
+                DELETE FROM objects WHERE uuid = ?
+            """, [(str(uuid),) for uuid in deleted_uuids])
+            self.write_conn.commit()
 
     def load_objects(self):
         # print("Object DB Loading...")
         if self.conn is None:
             log_error("Object DB Error: Database connection is not open")
             return []
-        self.cursor.execute("SELECT * FROM objects")
-        rows = self.cursor.fetchall()
+        with self.lock:
+            self.cursor.execute("SELECT * FROM objects")
+            rows = self.cursor.fetchall()
         objects = []
         for row in rows:
             try:
@@ -224,17 +330,130 @@ class ObjectDatabase:
 
             objects.append(obj)
         return objects
-    
-    def delete_object(self, uuid):
-        if self.conn is None:
-            log_error("Object DB Error: Database connection is not open")
+
+class PersistenceService:
+    """
+    Write-behind saving of players and objects.
+
+    save_player, save_object and delete_object only note what has changed. flush, called every
+    SAVE_INTERVAL seconds from timed_events, takes the rows on the game thread and queues them
+    for a background writer thread, which writes each batch in one transaction per database.
+    A save is then never waiting on the disk in the middle of a command or combat round.
+
+    If the writer fails to write a batch, everything in it is marked as changed again by the next
+    flush, so it is retried with the latest rows rather than lost.
+    """
+    def __init__(self, player_db, object_db):
+        self.player_db = player_db
+        self.object_db = object_db
+        self.dirty_players = {} # lower case name -> Player
+        self.dirty_objects = {} # uuid -> ObjectInstance
+        self.deleted_objects = set() # uuids
+        self.in_flight = Counter() # lower case names of players in batches the writer hasn't finished
+        # From batches the writer failed to write, handed back to the game thread by flush
+        self.failed_players = {}
+        self.failed_objects = {}
+        self.failed_deletes = set()
+        self.lock = threading.Lock()
+        self.batches = queue.Queue()
+        self.writer = threading.Thread(target=self.run_writer, name="persistence", daemon=True)
+        self.writer.start()
+
+    def save_player(self, player):
+        if player.name is None or player.name == "":
+            log_error("Persistence: Error saving player, player name is None or empty")
             return
+        self.dirty_players[player.name.lower()] = player
 
-        self.cursor.execute("""
-            DELETE FROM objects WHERE uuid = ?
-        """, (str(uuid),))
+    def save_object(self, obj):
+        self.deleted_objects.discard(obj.uuid)
+        self.dirty_objects[obj.uuid] = obj
 
-        self.conn.commit()
+    def delete_object(self, uuid):
+        self.dirty_objects.pop(uuid, None)
+        self.deleted_objects.add(uuid)
+
+    def is_pending(self, name):
+        """
+        Returns True if a save for the player hasn't reached the database yet.
+        """
+        name = name.lower()
+        with self.lock:
+            return name in self.dirty_players or self.in_flight[name] > 0 or name in self.failed_players
+
+    def flush(self, wait=False):
+        """
+        Queues everything changed since the last flush for the writer thread.
+
+        Args:
+            wait (bool, optional): Block until the writer has written everything queued, eg at shutdown. Defaults to False.
+
+        Returns:
+            None
+        """
+        self.retry_failed()
+        if self.dirty_players or self.dirty_objects or self.deleted_objects:
+            player_rows = []
+            for player in self.dirty_players.values():
+                try:
+                    version = player.get_version()
+                    player_rows.append(self.player_db.player_row(player))
+                    player.saved_version = version
+                except Exception as e:
+                    log_error(f"Persistence: Error saving player {player.name}: {e}")
+            object_rows = [self.object_db.object_row(obj) for obj in self.dirty_objects.values()]
+            batch = (dict(self.dirty_players), player_rows, dict(self.dirty_objects), object_rows, list(self.deleted_objects))
+            self.dirty_players.clear()
+            self.dirty_objects.clear()
+            self.deleted_objects.clear()
+            with self.lock:
+                self.in_flight.update(batch[0].keys())
+            self.batches.put(batch)
+        if wait:
+            self.batches.join()
+
+    def retry_failed(self):
+        """
+        Marks everything in batches the writer failed to write as changed again, on the game thread.
+        """
+        with self.lock:
+            if not (self.failed_players or self.failed_objects or self.failed_deletes):
+                return
+            players, self.failed_players = self.failed_players, {}
+            objects, self.failed_objects = self.failed_objects, {}
+            deleted_uuids, self.failed_deletes = self.failed_deletes, set()
+        for name, player in players.items():
+            player.saved_version = None
+            self.dirty_players.setdefault(name, player)
+        # Deletes first, so an object deleted since a failed save stays deleted
+        for uuid in deleted_uuids:
+            if uuid not in self.dirty_objects:
+                self.deleted_objects.add(uuid)
+        for uuid, obj in objects.items():
+            if uuid not in self.deleted_objects:
+                self.dirty_objects.setdefault(uuid, obj)
+
+    def run_writer(self):
+        while True:
+            players, player_rows, objects, object_rows, deleted_uuids = self.batches.get()
+            try:
+                if player_rows:
+                    self.player_db.save_players(player_rows)
+                if object_rows or deleted_uuids:
+                    self.object_db.write_objects(object_rows, deleted_uuids)
+            except Exception as e:
+                log_error(f"Persistence: Error writing {len(player_rows)} players and {len(object_rows)} objects, will retry: {e}")
+                with self.lock:
+                    self.failed_players.update(players)
+                    self.failed_objects.update(objects)
+                    self.failed_deletes.update(deleted_uuids)
+            finally:
+                with self.lock:
+                    self.in_flight.subtract(players.keys())
+                    for name in players:
+                        if self.in_flight[name] <= 0:
+                            del self.in_flight[name]
+                self.batches.task_done()
 
 class KeyedEntityManager:
     def __init__(self):
@@ -302,35 +521,24 @@ class ObjectInstanceManager(InstanceManager):
             object_instance.load()
             
     def save_objects(self):
-        objects = []
+        count = 0
         start_time = time.time()
         for vnum in self.instances:
             for obj in self.instances[vnum]:
                 if obj.state == ObjState.NORMAL: 
                     # don't save objects that are in NORMAL
                     continue
-                
-                # if an object's descriptions are the same as the template, set them to None
-                if obj.name == obj.template.short_desc:
-                    obj.name = None
-                if obj.desc == obj.template.long_desc:
-                    obj.desc = None
-                if obj.action_desc== obj.template.action_desc:
-                    obj.action_desc = None
-                
-                objects.append(obj)
-                
-                if obj.name is None:
-                    obj.name = obj.template.short_desc
-                if obj.desc is None:
-                    obj.desc = obj.template.long_desc
-                if obj.action_desc is None:
-                    obj.action_desc = obj.template.action_desc
+                persistence.save_object(obj)
+                count += 1
  
-        object_db.save_objects(objects)
-        log_info(f"Saved {len(objects)} objects in {time.time() - start_time:.2f} seconds")
+        persistence.flush()
+        log_info(f"Queued {count} objects for saving in {time.time() - start_time:.2f} seconds")
 
 class PlayerManager(KeyedEntityManager):
+    def __init__(self):
+        super().__init__()
+        self.input_pending = {} # players with queued commands, a dict used as an ordered set
+        self.output_pending = set() # players with something in their output buffer
    
     def get_players(self, LoggedIn=False):
         if not LoggedIn:
@@ -349,25 +557,91 @@ class PlayerManager(KeyedEntityManager):
     def save_all_players(self):
         start_time = time.time()
         for player in self.items.values():
-            if player.loggedin:
-                player_db.save_player(player)
+            if player.loggedin and player.get_version() != player.saved_version:
+                persistence.save_player(player)
+        persistence.flush()
         log_info(f"Player Manager: saved all players in {time.time() - start_time:.2f} seconds")
     
     def disconnect_player(self, player, msg=""):
         if msg:
             try:
-                player.socket.send(msg.encode('utf-8'))
+                # Last attempt at any unsent output, followed by the message, without blocking
+                player.outbound += player.output_buffer.take()
+                player.outbound += msg.encode('utf-8')
+                player.socket.send(player.outbound)
             except OSError:
-                pass # The socket is already closed
-        player.save()
-            
-        return self.remove(player.socket)
+                pass # The socket is already closed or the client isn't reading
+            player.outbound.clear()
+        if player.loggedin:
+            player.save()
+        self.input_pending.pop(player, None)
+        self.output_pending.discard(player)
+        
+        connected = self.get(player.socket) is player
+        self.remove(player.socket)
+        return connected
+
+class OutputBuffer:
+    """
+    Output waiting to be sent to a player.
+
+    Text is encoded as it is written and GMCP frames are appended as they are, so process_output
+    has one bytearray to send rather than a string to rebuild and encode again on every flush.
+    The first write marks the player in player_manager.output_pending, so process_output only
+    has to look at players with something to send.
+    """
+    def __init__(self, player):
+        self.player = player
+        self.data = bytearray()
+        self.has_text = False # GMCP on its own doesn't need a new prompt
+
+    def __len__(self):
+        return len(self.data)
+
+    def is_empty(self):
+        return not self.data
+
+    def write(self, text):
+        if not self.data:
+            player_manager.output_pending.add(self.player)
+        self.data += text.encode('utf-8', errors='replace')
+        self.has_text = True
+
+    def write_bytes(self, data):
+        if not self.data:
+            player_manager.output_pending.add(self.player)
+        self.data += data
+
+    def write_encoded(self, data):
+        """
+        Adds text that has already been encoded to UTF-8, eg a room broadcast encoded once for everyone in the room.
+        """
+        self.write_bytes(data)
+        self.has_text = True
+
+    def take(self):
+        """
+        Returns the buffered output and leaves the buffer empty.
+        """
+        data = self.data
+        self.data = bytearray()
+        self.has_text = False
+        return data
 
 class Player:
     def __init__(self, fd, socket):
         self.fd = fd
         self.socket = socket
-        self.output_buffer = ""
+        self.output_buffer = OutputBuffer(self) # text and GMCP frames waiting for process_output, in the order queued
+        self.outbound = bytearray() # encoded output the socket hasn't accepted yet
+        self.write_pending = False # socket is registered with the selector for EVENT_WRITE
+        self.input_buffer = bytearray() # bytes received that don't yet make up a full line
+        self.discarding_input = False # the rest of an over long line is being dropped, up to its newline
+        self.command_queue = deque() # complete lines waiting to be processed
+        self.telnet = None # mud_gmcp.TelnetParser, created when the first data arrives
+        self.wait_until = 0 # time.time() the player's wait state (lag) ends
+        self.address = None # client IP address
+        self.password_pending = False # a password check is running on mud_password's workers, input waits until it's done
         self.loggedin = False
         self.reconnect_prompt = False
         self.awaiting_reconnect_confirmation = False
@@ -390,10 +664,68 @@ class Player:
         self.lastlogin = datetime.now()
         self.title = ""
 
+        self.version = 0 # bumped when room_id, title or current_recall change, see get_version
+        self.saved_version = None # get_version() when the player was last saved or loaded
+
+    def queue_input(self, data):
+        """
+        Adds bytes received from the client to the input buffer and moves any complete lines onto the command queue.
+
+        A command split across two recv calls stays in the buffer until the rest of the line arrives.
+        Lines are only decoded once complete, so a UTF-8 character is never cut in half, and invalid
+        UTF-8 is replaced rather than dropping the whole line. A line longer than MAX_INPUT_LINE_LENGTH
+        is dropped whole, including any part still to arrive, so no tail of it is run as a command.
+
+        Returns:
+            int: The number of commands discarded because the command queue was full.
+        """
+        self.input_buffer += data
+        lines = self.input_buffer.split(b'\n')
+        self.input_buffer = lines.pop()
+
+        discarded = 0
+        for raw_line in lines:
+            if self.discarding_input:
+                self.discarding_input = False # the end of the over long line
+                continue
+            if len(raw_line) > mud_consts.MAX_INPUT_LINE_LENGTH:
+                log_error(f"Player {self.fd} sent a line longer than {mud_consts.MAX_INPUT_LINE_LENGTH} bytes, discarding")
+                continue
+            line = raw_line.decode('utf-8', errors='replace').strip()
+            if line == '':
+                continue
+            if len(self.command_queue) >= mud_consts.MAX_QUEUED_COMMANDS:
+                discarded += 1
+            else:
+                self.command_queue.append(line)
+
+        if len(self.input_buffer) > mud_consts.MAX_INPUT_LINE_LENGTH:
+            if not self.discarding_input:
+                log_error(f"Player {self.fd} sent a line longer than {mud_consts.MAX_INPUT_LINE_LENGTH} bytes, discarding")
+            self.input_buffer.clear()
+            self.discarding_input = True
+        return discarded
+
+    def add_wait_state(self, beats):
+        """Lags the player for the given number of beats, queued commands wait until it has passed."""
+        self.wait_until = max(self.wait_until, time.time() + beats * mud_consts.WAIT_STATE_BEAT)
+
+    def in_wait_state(self, current_time):
+        return self.wait_until > current_time
+
+    def get_version(self):
+        """
+        Returns the versions of everything saved for the player, save_all_players skips players
+        whose versions are the same as when they were last saved.
+        """
+        return (self.version, self.character.version, self.character.abilities.version, self.inventory.version, self.equipment.version)
+
     def save(self):
-        player_db.save_player(self)
+        persistence.save_player(self)
 
     def load(self):
+        if persistence.is_pending(self.name):
+            persistence.flush(wait=True)
         player_data = player_db.load_player(self.name)
         if player_data is None:
             return False
@@ -403,19 +735,24 @@ class Player:
         self.created = player_data['created']
         self.lastlogin = datetime.now()
         self.title = player_data['title']
-        self.inventory.uuids = player_data['inventory']
+        self.inventory.set_uuids(player_data['inventory'])
         self.character = player_data['character']
+        self.saved_version = self.get_version()
 
         return True
         
     def save_exists(self):
-        return player_db.load_player(self.name) is not None
+        if persistence.is_pending(self.name):
+            persistence.flush(wait=True)
+        return player_db.player_exists(self.name)
 
     def set_room(self, room):
         self.current_room = room
 
     def move_to_room(self, new_room):
-        self.room_id = new_room.vnum
+        if self.room_id != new_room.vnum:
+            self.room_id = new_room.vnum
+            self.version += 1
         if self.current_room is not None:
             self.current_room.remove_player(self)
         if new_room is not None:
@@ -460,9 +797,6 @@ class Player:
     def get_objects(self):
         return {object_instance_manager.get_object_by_uuid(uuid) for uuid in self.inventory.get_all()}
     
-    def get_containers(self):
-        return {obj for obj in self.get_objects() if obj.is_container()}
-    
     def get_title(self):
         if self.title == "":
             return f"the {self.character.origin}"
@@ -470,12 +804,14 @@ class Player:
     
     def set_title(self, title):
         self.title = title
+        self.version += 1
         
     def get_recall(self):
         return self.current_recall
     
     def set_recall(self, room=0):
         self.current_recall = room
+        self.version += 1
         
     def get_prompt(self):
         return self.character.get_prompt()
@@ -503,7 +839,23 @@ class Player:
 
             
 
+# The prompt's colour codes never change, so they are applied once and get_prompt only fills in the numbers
+PROMPT_TEMPLATE = (colourize("\n<HP: ", "green") + colourize("{}", "white") + colourize("/{}", "green")
+                   + colourize(" MP: ", "green") + colourize("{}", "white") + colourize("/{}", "green")
+                   + colourize(" SP: ", "green") + colourize("{}", "white") + colourize("/{}", "green")
+                   + colourize(" {}", "yellow") + colourize("> \n", "green"))
+
 class Character:
+    prompt_cache = None # (values, prompt) from the last get_prompt, class level so characters saved before it existed still load
+    version = 0 # bumped by the methods below and wherever saved attributes are changed directly, see Player.get_version
+
+    # Attributes to_dict saves as they are. abilities and muted_channels are converted, the rest
+    # are either rebuilt (prompt_cache) or refer to other live objects (combat_with, current_target).
+    saved_attributes = ('level', 'race', 'origin', 'death_room', 'NPC',
+                        'max_hitpoints', 'current_hitpoints', 'max_mana', 'current_mana', 'max_stamina', 'current_stamina',
+                        'position', 'str', 'dex', 'con', 'int', 'wis', 'cha', 'ac', 'hitroll',
+                        'damdice_num', 'damdice_size', 'damdice_bonus', 'xp', 'tnl', 'gold', 'alignment', 'racials')
+
     def __init__(self, NPC=False):
         self.level = 1
         self.race = ""
@@ -547,10 +899,46 @@ class Character:
         
         self.racials = []
         self.abilities = Abilities()
+        self.muted_channels = set() # names of mud_channels channels the player has turned off
+
+    def to_dict(self):
+        """
+        Returns the character as a dict of JSON types, see PlayerDatabase.player_row.
+
+        Attributes the character doesn't have, eg on a character pickled before they were added,
+        are left out so from_dict uses the defaults from __init__.
+        """
+        attributes = self.__dict__
+        data = {name: attributes[name] for name in self.saved_attributes if name in attributes}
+        if 'abilities' in attributes:
+            data['abilities'] = self.abilities.to_dict()
+        if 'muted_channels' in attributes:
+            data['muted_channels'] = sorted(self.muted_channels)
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        character = cls()
+        for name in cls.saved_attributes:
+            if name in data:
+                setattr(character, name, data[name])
+        if 'abilities' in data:
+            character.abilities = Abilities.from_dict(data['abilities'])
+        character.muted_channels = set(data.get('muted_channels', ()))
+        return character
    
     def get_prompt(self):
-        c = colourize
-        return c("\n<HP: ", "green") + c(f"{self.current_hitpoints}", "white") + c(f"/{self.max_hitpoints}", "green") + c(" MP: ", "green") + c(f"{self.current_mana}", "white") + c(f"/{self.max_mana}", "green") + c(" SP: ", "green") + c(f"{self.current_stamina}", "white") + c(f"/{self.max_stamina}", "green") + c(f" {self.tnl-self.xp}", "yellow") + c("> \n", "green")
+        """
+        Returns the character's prompt, only rendering it again when one of the values shown has changed.
+
+        The cache is keyed on the values themselves rather than a version number, as hitpoints, mana
+        etc. are assigned directly all over the code base and a missed bump would show a stale prompt.
+        """
+        values = (self.current_hitpoints, self.max_hitpoints, self.current_mana, self.max_mana,
+                  self.current_stamina, self.max_stamina, self.tnl - self.xp)
+        if self.prompt_cache is None or self.prompt_cache[0] != values:
+            self.prompt_cache = (values, PROMPT_TEMPLATE.format(*values))
+        return self.prompt_cache[1]
 
     def set_racial_stats(self, str, dex, con, int, wis, cha, tnl, racials):
         self.str = str
@@ -561,6 +949,7 @@ class Character:
         self.cha = cha
         self.tnl = tnl
         self.racials = racials
+        self.version += 1
           
     def get_hitroll(self):
         return self.hitroll + self.dex - 10
@@ -577,6 +966,7 @@ class Character:
     
     def apply_damage(self, damage):
         self.current_hitpoints -= damage
+        self.version += 1
         
     def is_dead(self):
         return self.current_hitpoints <= 0
@@ -590,12 +980,14 @@ class Character:
     def set_position(self, position):
         if position in ["Stand", "Rest", "Sleep"]:
             self.position = position
+            self.version += 1
         else:
             log_error(f"Invalid position {position}")
     
     def gain_experience(self, xp):
         msg = ""
         self.xp += xp
+        self.version += 1
         if self.xp >= self.tnl:
             while self.xp >= self.tnl:
                 self.xp -= self.tnl
@@ -606,11 +998,13 @@ class Character:
     def death_xp_loss(self):
         death_xp_loss = dice_roll(self.level, 10, 25)
         self.xp -= death_xp_loss
+        self.version += 1
         return f"You have lost {death_xp_loss} experience!\n"
     
     def flee_xp_loss(self):
         flee_xp_loss = dice_roll(self.level, 5, 10)
         self.xp -= flee_xp_loss
+        self.version += 1
         return f"You have lost {flee_xp_loss} experience!\n"
             
     def level_up(self):
@@ -623,19 +1017,30 @@ class Character:
         self.current_mana = self.max_mana
         # self.max_stamina += dice_roll(1, 10, self.str - 10)
         self.current_stamina = self.max_stamina
+        self.version += 1
         return f"You have gained {hp_gain} hitpoints and {mana_gain} mana!\n"
     
     def regen_hp(self, amount):
         amount = round(amount)
-        self.current_hitpoints = min(self.max_hitpoints, self.current_hitpoints + amount)
+        # Regen at full hitpoints changes nothing, so leaves the version alone
+        hitpoints = min(self.max_hitpoints, self.current_hitpoints + amount)
+        if hitpoints != self.current_hitpoints:
+            self.current_hitpoints = hitpoints
+            self.version += 1
         
     def regen_mana(self, amount):
         amount = round(amount)
-        self.current_mana = min(self.max_mana, self.current_mana + amount)
+        mana = min(self.max_mana, self.current_mana + amount)
+        if mana != self.current_mana:
+            self.current_mana = mana
+            self.version += 1
         
     def regen_stamina(self, amount):
         amount = round(amount)
-        self.current_stamina = min(self.max_stamina, self.current_stamina + amount)
+        stamina = min(self.max_stamina, self.current_stamina + amount)
+        if stamina != self.current_stamina:
+            self.current_stamina = stamina
+            self.version += 1
         
     def tick(self, room):
         # update spell lengths
@@ -674,17 +1079,42 @@ class Character:
 class Inventory:
     def __init__(self):
         self.uuids = set() # set of object UUIDs (saved)
+        self.index = KeywordIndex() # the objects themselves, by keyword (not saved)
+        self.version = 0 # bumped when objects are added or removed, see Player.get_version
 
     def add(self, object):
         self.uuids.add(object.uuid)
+        self.index.add(object)
+        self.version += 1
         
     def remove(self, object):
         self.uuids.remove(object.uuid)
+        self.index.remove(object)
+        self.version += 1
         
     def get_all(self):
         return self.uuids
+
+    def set_uuids(self, uuids):
+        """
+        Replaces the inventory with the objects with the given UUIDs, eg when a player is loaded.
+        """
+        self.uuids = set(uuids)
+        self.index.clear()
+        self.version += 1
+        for object_uuid in self.uuids:
+            obj = object_instance_manager.get_object_by_uuid(object_uuid)
+            if obj is None:
+                log_error(f"Inventory: no object instance found with uuid {object_uuid}")
+                continue
+            self.index.add(obj)
+
+    def search(self, keyword, condition=None):
+        return search_indexes([self.index], keyword, condition)
    
 class Equipment:
+    version = 0 # bumped by equip and unequip, class level so equipment saved before it existed still loads
+
     def __init__(self):
         # Key: EquipSlots enum, Value: object UUID
         self.slots = {
@@ -705,9 +1135,32 @@ class Equipment:
             EquipSlots.HELD: None                 
         }
 
+    def to_dict(self):
+        slots = {}
+        for slot, value in self.slots.items():
+            if isinstance(value, list):
+                slots[slot.name] = [str(object_uuid) if object_uuid is not None else None for object_uuid in value]
+            else:
+                slots[slot.name] = str(value) if value is not None else None
+        return {'slots': slots}
+
+    @classmethod
+    def from_dict(cls, data):
+        equipment = cls()
+        for name, value in data.get('slots', {}).items():
+            if name not in EquipSlots.__members__:
+                log_error(f"Equipment: unknown slot {name}")
+                continue
+            if isinstance(value, list):
+                equipment.slots[EquipSlots[name]] = [uuid.UUID(object_uuid) if object_uuid is not None else None for object_uuid in value]
+            else:
+                equipment.slots[EquipSlots[name]] = uuid.UUID(value) if value is not None else None
+        return equipment
+
     def equip(self, slot, item):
         if slot in self.slots and self.slots[slot] is None:
             self.slots[slot] = item.uuid
+            self.version += 1
         else:
             raise ValueError(f"Cannot equip {item} to {slot}")
 
@@ -715,6 +1168,7 @@ class Equipment:
         if slot in self.slots and self.slots[slot] is not None:
             item_uuid = self.slots[slot]
             self.slots[slot] = None
+            self.version += 1
             return item_uuid
         else:
             raise ValueError(f"Cannot unequip from {slot}")
@@ -763,6 +1217,7 @@ class MobTemplate:
     def __init__(self, vnum, keywords, short_desc, long_desc, desc, act_flags, aff_flags, align, level, hitroll, ac, hitdice_num, hitdice_size, hitdice_bonus, damdice_num, damdice_size, damdice_bonus, gold, xp, sex):
         self.vnum = vnum
         self.keywords = keywords
+        self.keyword_tuple = intern_keywords(keywords) # shared by every instance
         self.short_desc = short_desc
         self.long_desc = long_desc
         self.desc = desc
@@ -801,9 +1256,10 @@ class MobTemplate:
         return dice_roll(self.hitdice_num, self.hitdice_size, self.hitdice_bonus)
         
 class ObjectTemplate:
-    def __init__(self, vnum):
+    def __init__(self, vnum, keywords=""):
         self.vnum = vnum
-        self.keywords = ""
+        self.keywords = keywords.lower()
+        self.keyword_tuple = intern_keywords(keywords) # shared by every instance
         self.short_desc = ""
         self.long_desc = ""
         self.action_desc = ""
@@ -833,11 +1289,27 @@ class Room:
         self.doors = {}
         self.extended_descriptions = []
     
-        self.mob_list = set()
-        self.object_list = set()
-        self.player_list = set()
-        self.door_list = set()
-        self.extended_descriptions_list = set()
+        # dicts used as ordered sets, so the room's contents are always listed in the order they arrived
+        self.mob_list = {}
+        self.object_list = {}
+        self.player_list = {}
+        self.door_list = {}
+        self.extended_descriptions_list = {}
+
+        # Keyword indexes of the above, kept up to date by the add/remove methods below
+        self.mob_index = KeywordIndex()
+        self.object_index = KeywordIndex()
+        self.player_index = KeywordIndex()
+        self.door_index = KeywordIndex()
+        self.extended_description_index = KeywordIndex()
+
+        self.indexes = {
+            RoomContents.PLAYERS: self.player_index,
+            RoomContents.MOBS: self.mob_index,
+            RoomContents.OBJECTS: self.object_index,
+            RoomContents.DOORS: self.door_index,
+            RoomContents.EXTENDED_DESCRIPTIONS: self.extended_description_index,
+        }
 
     def add_door(self, door_number, door_description, keywords, locks, key, to_room):
         self.doors[door_number] = {
@@ -847,32 +1319,42 @@ class Room:
             "key": key,
             "to_room": to_room
         }
-        self.door_list.add(Door(door_number, door_description, keywords, locks, key, to_room))
+        door = Door(door_number, door_description, keywords, locks, key, to_room)
+        self.door_list[door] = None
+        self.door_index.add(door)
 
     def add_extended_description(self, keywords, description):
         self.extended_descriptions.append({
             "keywords": keywords,
             "description": description
         })
-        self.extended_descriptions_list.add(ExtendedDescription(keywords, description))
+        extended_description = ExtendedDescription(keywords, description)
+        self.extended_descriptions_list[extended_description] = None
+        self.extended_description_index.add(extended_description)
         
     def add_player(self, player):
-        self.player_list.add(player)
+        self.player_list[player] = None
+        self.player_index.add(player)
         
     def remove_player(self, player):
-        self.player_list.discard(player)
+        self.player_list.pop(player, None)
+        self.player_index.remove(player)
         
     def add_mob(self, mob):
-        self.mob_list.add(mob)
+        self.mob_list[mob] = None
+        self.mob_index.add(mob)
         
     def remove_mob(self, mob):
-        self.mob_list.discard(mob)
+        self.mob_list.pop(mob, None)
+        self.mob_index.remove(mob)
         
     def add_object(self, obj):
-        self.object_list.add(obj)
+        self.object_list[obj] = None
+        self.object_index.add(obj)
         
     def remove_object(self, obj):
-        self.object_list.discard(obj)
+        self.object_list.pop(obj, None)
+        self.object_index.remove(obj)
         
     def get_exit_names(self):
         available_exits = []
@@ -928,6 +1410,50 @@ class Room:
     
     def get_players(self):
         return self.player_list
+
+    def search(self, keyword, kinds=ROOM_CHARACTERS, condition=None):
+        """
+        Finds the contents of the room matching a keyword, eg 2.guard, through the keyword indexes.
+
+        Matches are numbered by kind in the order given, then in the order they arrived in the room,
+        so 2.guard is the same guard each time.
+
+        Args:
+            keyword (str): The keyword to search for, optionally with a number, eg 2.guard.
+            kinds (tuple of RoomContents, optional): What to search. Defaults to players and mobs.
+            condition (function, optional): Only contents for which this returns True are counted.
+
+        Returns:
+            object: The matching player, mob, object etc or None.
+        """
+        return search_indexes([self.indexes[kind] for kind in kinds], keyword, condition)
+
+    def broadcast(self, msg, variants=None):
+        """
+        Sends a message to every awake player in the room.
+
+        Each distinct message is encoded once and the same bytes are added to every recipient's
+        output buffer, rather than each player's copy of the string being encoded separately.
+
+        Args:
+            msg (str): The message for everyone in the room, or None to only send the variants.
+            variants (dict, optional): Player -> message for players who should see something else,
+                eg the actor and target of an act message. A message of None sends them nothing.
+
+        Returns:
+            None
+        """
+        encoded = {}
+        for player in self.player_list:
+            if player.character.NPC or not player.character.is_awake():
+                continue
+            text = variants.get(player, msg) if variants else msg
+            if text is None:
+                continue
+            data = encoded.get(text)
+            if data is None:
+                data = encoded[text] = text.encode('utf-8', errors='replace')
+            player.output_buffer.write_encoded(data)
     
     def get_mobs(self):
         return self.mob_list
@@ -935,9 +1461,6 @@ class Room:
     def get_objects(self):
         return self.object_list
     
-    def get_containers(self):
-        return {obj for obj in self.object_list if obj.is_container()}
-    
     def get_doors(self):
         return self.door_list
     
@@ -992,12 +1515,13 @@ class Door:
         self.door_number = door_number
         self.description = door_description
         self.keywords = keywords
+        self.keyword_tuple = intern_keywords(keywords)
         self.locks = locks
         self.key = key
         self.to_room = to_room
         
     def get_keywords(self):
-        return self.keywords.split()
+        return self.keyword_tuple
     
     def get_description(self):
         return self.description
@@ -1005,10 +1529,11 @@ class Door:
 class ExtendedDescription:
     def __init__(self, keywords, description):
         self.keywords = keywords
+        self.keyword_tuple = intern_keywords(keywords)
         self.description = description
         
     def get_keywords(self):
-        return self.keywords.split()
+        return self.keyword_tuple
     
     def get_description(self):
         return self.description 
@@ -1049,13 +1574,10 @@ class MobInstance:
         self.aggro_list = set()
         
     def get_keywords(self):
-        return self.template.keywords.split()
+        return self.template.keyword_tuple
     
     def get_objects(self):
         return {object_instance_manager.get_object_by_uuid(uuid) for uuid in self.inventory.get_all()}
-    
-    def get_containers(self):
-        return {obj for obj in self.get_objects() if obj.is_container()}
 
     def set_room(self, room):
         self.current_room = room
@@ -1152,7 +1674,7 @@ class ObjectInstance:
                  
                     
     def save(self):
-        object_db.save_object(self)
+        persistence.save_object(self)
        
     def load(self):
         if self.location_type == ObjLocationType.ROOM:
@@ -1189,7 +1711,7 @@ class ObjectInstance:
             log_error(f"Object imp: object {self.vnum} {self.name} is not in a known location: {self.location_type}")
             return
         
-        object_db.delete_object(self.uuid)
+        persistence.delete_object(self.uuid)
         object_instance_manager.remove(self)      
         
     
@@ -1215,7 +1737,7 @@ class ObjectInstance:
             log_error(f"Invalid state {state} (object {self.vnum} {self.name})")
             
     def get_keywords(self):
-        return self.template.keywords.split()
+        return self.template.keyword_tuple
     
     def get_description(self):
         description = []
@@ -1506,19 +2028,24 @@ class CombatManager:
     def get_characters_in_combat(self):
         return list(self.combat_dict.keys())
     
+    ROUNDS_IN_MILLISECONDS = 2000
+
     def next_round(self):
-        ROUNDS_IN_MILLISECONDS = 2000
         elapsed_time_ms = (time.time() - self.last_update) * 1000
-        if elapsed_time_ms > ROUNDS_IN_MILLISECONDS:
+        if elapsed_time_ms > self.ROUNDS_IN_MILLISECONDS:
             self.last_update = time.time()
             return True
         else:
             return False
 
+    def seconds_until_next_round(self, current_time):
+        return max(0, self.last_update + self.ROUNDS_IN_MILLISECONDS / 1000 - current_time)
+
 # Init Global databases
-from mud_consts import DATABASE_FOLDER, PLAYER_DATABASE, OBJECT_DATABASE
-player_db = PlayerDatabase(DATABASE_FOLDER + "/" + PLAYER_DATABASE)
-object_db = ObjectDatabase(DATABASE_FOLDER + "/" + OBJECT_DATABASE)
+from mud_consts import PLAYER_DATABASE, OBJECT_DATABASE
+player_db = PlayerDatabase(PLAYER_DATABASE)
+object_db = ObjectDatabase(OBJECT_DATABASE)
+persistence = PersistenceService(player_db, object_db)
 
 # Init Player Manager
 player_manager = PlayerManager()
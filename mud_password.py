@@ -2,12 +2,15 @@
 
 import hashlib
 import os
-import sqlite3
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-from mud_consts import DATABASE_FOLDER, USER_DATABASE
+from mud_consts import USER_DATABASE, PASSWORD_WORKERS
+from mud_shared import log_info, log_error
+from mud_db import db_manager
 
 # Global connection and cursor
-conn = sqlite3.connect(DATABASE_FOLDER + "/" + USER_DATABASE)
+conn = db_manager.connect(USER_DATABASE)
 cursor = conn.cursor()
 
 # Create the table if it doesn't exist
@@ -18,13 +21,66 @@ cursor.execute('''
     )
 ''')
 
+# Usernames are lower cased on write so they can be looked up by the primary key, this catches any saved before that
+cursor.execute('UPDATE OR IGNORE users SET username = LOWER(username) WHERE username != LOWER(username)')
+if cursor.rowcount > 0:
+    log_info(f"User_DB: lower cased {cursor.rowcount} usernames")
+# Any left clash with another user when lower cased, and can't log in until renamed by hand
+cursor.execute('SELECT username FROM users WHERE username != LOWER(username)')
+for (username,) in cursor.fetchall():
+    log_error(f"User_DB: {username} clashes with another user's name when lower cased")
+conn.commit()
+
+# PBKDF2 takes tens of milliseconds, too long to run on the game thread, so hash_password and
+# verify_password are run on a worker pool. See submit.
+password_pool = ThreadPoolExecutor(max_workers=PASSWORD_WORKERS, thread_name_prefix="password")
+
+# (future, callback) pairs finished by a worker, waiting for run_completed on the game thread
+completed = deque()
+
+# Called from the worker thread when a job finishes, so the game loop wakes up to run run_completed.
+# Set by the server, eg a write to a socket pair registered with the selector.
+wakeup = None
+
+def submit(func, args, callback):
+    """
+    Runs func(*args) on the password pool, then callback(future) on the game thread.
+
+    The database isn't touched off the game thread, only the hashing, so load the stored password
+    first and store the new hash in the callback.
+
+    Args:
+        func (function): hash_password or verify_password.
+        args (tuple): The arguments for func.
+        callback (function): Called with the finished future from run_completed.
+
+    Returns:
+        None
+    """
+    def done(future):
+        completed.append((future, callback))
+        if wakeup is not None:
+            wakeup()
+
+    password_pool.submit(func, *args).add_done_callback(done)
+
+def run_completed():
+    """
+    Runs the callbacks for finished password jobs, called from the game loop.
+    """
+    while completed:
+        future, callback = completed.popleft()
+        try:
+            callback(future)
+        except Exception as e:
+            log_error(f"Unexpected error while finishing password check: {e}")
+
 def hash_password(password):
     salt = os.urandom(32) # A new salt for this user
     hashed = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, 100000)
     return salt + hashed
 
-def save_password(username, password):
-    hashed_password = hash_password(password)
+def store_password(username, hashed_password):
     cursor.execute('INSERT INTO users VALUES (?, ?)', (username.lower(), hashed_password))
     conn.commit()
 
@@ -37,4 +93,4 @@ def verify_password(stored_password, provided_password):
     salt = stored_password[:32] # 32 is the length of the salt
     stored_password = stored_password[32:]
     hashed = hashlib.pbkdf2_hmac('sha256', provided_password.encode('utf-8'), salt, 100000)
-    return hashed == stored_password
\ No newline at end of file
+    return hashed == stored_password
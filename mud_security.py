@@ -0,0 +1,186 @@
+# mud_security.py
+
+import time
+import ipaddress
+
+from mud_consts import BANLIST, TEMPBANS, CONNECT_RATE, CONNECT_BURST, LOGIN_FAILURE_RATE, LOGIN_FAILURE_BURST, TEMP_BAN_SECONDS
+from mud_shared import log_info, log_error
+
+class TokenBucket:
+    """
+    Allows up to capacity events at once, refilling at rate events per second.
+    """
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, now):
+        """
+        Takes a token if there's one left, returns False if the bucket is empty.
+        """
+        self.refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def is_full(self, now):
+        self.refill(now)
+        return self.tokens >= self.capacity
+
+class SecurityManager:
+    """
+    Decides which connections and logins are let through, in front of handle_new_client.
+
+    Bans are loaded from BANLIST, one IP address or CIDR network (eg 203.0.113.0/24) per line,
+    with # starting a comment. The server only ever reads it, it can be edited and reloaded at
+    runtime with SIGHUP. Temporary bans are kept in TEMPBANS with the time they expire, eg
+    "203.0.113.7 1735689600", and dropped from it once they have.
+
+    Each IP also gets a token bucket for connecting and one for failed logins. An IP that empties
+    either bucket is banned for TEMP_BAN_SECONDS.
+    """
+    def __init__(self):
+        self.banned_networks = set()
+        self.banned_prefixes = set() # prefix lengths in banned_networks, each checked with one set lookup
+        self.temp_bans = {} # ip -> time.time() the ban ends
+        self.connect_buckets = {}
+        self.login_failure_buckets = {}
+        self.next_prune = 0
+
+    def read_bans(self, filename):
+        """
+        Returns the fields of each line of a ban file, without comments and blank lines, or None if it couldn't be read.
+        """
+        lines = []
+        try:
+            with open(filename, 'r') as file:
+                for line in file:
+                    fields = line.split('#', 1)[0].split()
+                    if fields:
+                        lines.append(fields)
+        except FileNotFoundError:
+            if filename == BANLIST:
+                log_info(f"{BANLIST} not found, no bans loaded")
+        except Exception as e:
+            log_error(f"Unexpected error while reading {filename}: {e}")
+            return None
+        return lines
+
+    def load(self):
+        ban_lines = self.read_bans(BANLIST)
+        temp_ban_lines = self.read_bans(TEMPBANS)
+        if ban_lines is None or temp_ban_lines is None:
+            return
+
+        banned_networks = set()
+        for fields in ban_lines:
+            try:
+                banned_networks.add(ipaddress.ip_network(fields[0], strict=False))
+            except ValueError:
+                log_error(f"Ignoring invalid ban in {BANLIST}: {' '.join(fields)}")
+
+        temp_bans = {}
+        now = time.time()
+        for fields in temp_ban_lines:
+            try:
+                expires = float(fields[1])
+                if expires > now:
+                    temp_bans[str(ipaddress.ip_address(fields[0]))] = expires
+            except (ValueError, IndexError):
+                log_error(f"Ignoring invalid temporary ban in {TEMPBANS}: {' '.join(fields)}")
+
+        self.banned_networks = banned_networks
+        self.banned_prefixes = {network.prefixlen for network in banned_networks}
+        self.temp_bans = temp_bans
+        log_info(f"Loaded {len(banned_networks)} bans and {len(temp_bans)} temporary bans")
+
+    def save_temp_bans(self):
+        now = time.time()
+        try:
+            with open(TEMPBANS, 'w') as file:
+                for ip, expires in self.temp_bans.items():
+                    if expires > now:
+                        file.write(f"{ip} {int(expires)}\n")
+        except OSError as e:
+            log_error(f"Error writing {TEMPBANS}: {e}")
+
+    def is_banned(self, ip, now=None):
+        if now is None:
+            now = time.time()
+        expires = self.temp_bans.get(ip)
+        if expires is not None:
+            if expires > now:
+                return True
+            del self.temp_bans[ip]
+        if not self.banned_prefixes:
+            return False
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return False
+        for prefixlen in self.banned_prefixes:
+            if prefixlen > address.max_prefixlen:
+                continue
+            if ipaddress.ip_network(f"{address}/{prefixlen}", strict=False) in self.banned_networks:
+                return True
+        return False
+
+    def temp_ban(self, ip, reason, now):
+        self.temp_bans[ip] = now + TEMP_BAN_SECONDS
+        self.connect_buckets.pop(ip, None)
+        self.login_failure_buckets.pop(ip, None)
+        log_info(f"Temporarily banned {ip} for {TEMP_BAN_SECONDS} seconds: {reason}")
+        self.save_temp_bans()
+
+    def allow_connection(self, ip):
+        """
+        Returns True if a new connection from ip should be accepted, taking a connect token.
+        """
+        now = time.time()
+        self.prune(now)
+        if self.is_banned(ip, now):
+            return False
+        bucket = self.connect_buckets.get(ip)
+        if bucket is None:
+            bucket = self.connect_buckets[ip] = TokenBucket(CONNECT_RATE, CONNECT_BURST, now)
+        if not bucket.consume(now):
+            self.temp_ban(ip, "too many connections", now)
+            return False
+        return True
+
+    def login_failed(self, ip):
+        """
+        Records a wrong password from ip. Returns True if ip has now been banned.
+        """
+        now = time.time()
+        bucket = self.login_failure_buckets.get(ip)
+        if bucket is None:
+            bucket = self.login_failure_buckets[ip] = TokenBucket(LOGIN_FAILURE_RATE, LOGIN_FAILURE_BURST, now)
+        if not bucket.consume(now):
+            self.temp_ban(ip, "too many failed logins", now)
+            return True
+        return False
+
+    def prune(self, now):
+        # Full buckets are the same as no bucket, so drop them now and then to stop the dicts growing
+        if now < self.next_prune:
+            return
+        self.next_prune = now + 60
+        for buckets in (self.connect_buckets, self.login_failure_buckets):
+            for ip in [ip for ip, bucket in buckets.items() if bucket.is_full(now)]:
+                del buckets[ip]
+        expired = [ip for ip, expires in self.temp_bans.items() if expires <= now]
+        for ip in expired:
+            del self.temp_bans[ip]
+        if expired:
+            self.save_temp_bans()
+
+# Init Global security manager
+security_manager = SecurityManager()
@@ -1,22 +1,26 @@
 # mud_sever.py
 
+import sys
 import time
 import signal
+import asyncio
 import socket
-import select
+import selectors
 
 VERSION = "0.0.1"
 
-from mud_comms import handle_new_client, handle_shutdown, handle_disconnection, handle_client_login, process_output
+from mud_comms import handle_new_client, handle_shutdown, handle_disconnection, handle_client_login, process_output, write_output, send_message, selector
 from mud_handler import handle_player
 from mud_world import build_world, reset_world, build_objects
 from mud_shared import log_info, log_error
 from mud_combat import combat_loop
-from mud_ticks import timed_events
-from mud_gmcp import handle_gmcp_negotiation, handle_gmcp_message, send_gmcp_messages
-from mud_gmcp import TELNET_WILL_SUPPORT, TELNET_WONT_SUPPORT, TELNET_GMCP_ASK_SUPPORTED, TELNET_GMCP_MSG_START
-from mud_objects import player_manager
-from mud_consts import BANLIST
+from mud_ticks import timed_events, time_manager
+from mud_gmcp import TelnetParser, handle_telnet_event
+from mud_gmcp import TELNET_GMCP_ASK_SUPPORTED
+from mud_objects import player_manager, combat_manager
+import mud_password
+from mud_security import security_manager
+from mud_consts import RECV_BUFFER_SIZE, COMMANDS_PER_PULSE, MAX_OUTPUT_BUFFER
 
 from mud_shared import log_msg
 def log_client_input(player, msg):
@@ -26,25 +30,6 @@ def log_client_input(player, msg):
         log_msg(f"[PLAYER]: {player.name}): {msg.rstrip()}")
     else:
         log_msg(f"[PLAYER]: {player.fd}): {msg.rstrip()}")   
-        
-import ipaddress
-
-def load_ban_list():
-    ban_list = []
-    try:
-        with open(BANLIST, 'r') as file:
-            for line in file:
-                ip = line.strip()  # Remove any leading/trailing whitespace
-                try:
-                    ipaddress.ip_address(ip)  # Check if it's a valid IP
-                    ban_list.append(ip)
-                except ValueError:
-                    print(f"Ignoring invalid IP: {ip}")
-    except FileNotFoundError:
-        print("banlist.txt not found.")
-    except Exception as e:
-        print(f"Unexpected error while reading banlist.txt: {e}")
-    return ban_list          
 
 def start_server(port=4000):
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -53,121 +38,320 @@ def start_server(port=4000):
 
     log_info(f"Server listening on port {port}")
     
-    # Set up signal handler for SIGINT
+    # Set up signal handlers for SIGINT and SIGHUP
     signal.signal(signal.SIGINT, shutdown_handler)
+    signal.signal(signal.SIGHUP, reload_handler)
 
     game_loop(server_socket)
     
 def game_loop(server_socket):
-    ban_list = load_ban_list()
+    security_manager.load()
     
-    while True:
-        # Rebuild the list of sockets to monitor at the start of each loop iteration
-        sockets = [server_socket] + [player.socket for player in player_manager.get_players()]
+    # The listening socket is registered with no player attached
+    server_socket.setblocking(False)
+    selector.register(server_socket, selectors.EVENT_READ, None)
 
-        # Use select to wait for data to be available on any socket
-        ready_to_read, _, _ = select.select(sockets, [], [], 0)
+    # Password workers write a byte here when they finish, waking the select up
+    wakeup_reader, wakeup_writer = socket.socketpair()
+    wakeup_reader.setblocking(False)
+    wakeup_writer.setblocking(False)
+    selector.register(wakeup_reader, selectors.EVENT_READ, wakeup_reader)
+    mud_password.wakeup = lambda: send_wakeup(wakeup_writer)
+    
+    while True:
+        # Block until a socket is ready or the next timed event (combat round, tick etc.) is due
+        current_time = time.time()
+        timeout = min(combat_manager.seconds_until_next_round(current_time), time_manager.seconds_until_next_event(current_time))
+        command_timeout = seconds_until_next_command(current_time)
+        if command_timeout is not None:
+            timeout = min(timeout, command_timeout)
+        events = selector.select(timeout)
 
-        # First, read all data
-        player_data = {}
-        for sock in ready_to_read:
-            if sock is server_socket:
+        # First, write any output left over from last time and read all data
+        for key, mask in events:
+            if key.data is wakeup_reader:
+                try:
+                    wakeup_reader.recv(RECV_BUFFER_SIZE)
+                except BlockingIOError:
+                    pass
+            elif key.data is None:
                 # If the server socket is ready to read, a new connection is available
                 try:
                     client_sock, addr = server_socket.accept()
-                    if addr[0] in ban_list:
+                    if not security_manager.allow_connection(addr[0]):
                         log_info(f"Rejected connection from banned IP {addr}")
                         client_sock.close()
                         continue
                     client_sock.setblocking(False)  # Set to non-blocking mode
                     log_info(f"Accepted connection from {addr}")
-                    handle_new_client(client_sock)
-                    sockets.append(client_sock)  # Add the new socket to the list
+                    handle_new_client(client_sock, address=addr[0])
                     client_sock.send(TELNET_GMCP_ASK_SUPPORTED) # Ask the client if they support GMCP
+                except BlockingIOError:
+                    pass # Another loop iteration already accepted the connection
                 except OSError as e:
                     log_error(f"OS error while accepting new connection: {e}")
-                except socket.error as e:
-                    log_error(f"Socket error while accepting new connection: {e}")
                 except Exception as e:  # This will catch any other types of exceptions
                     log_error(f"Unexpected error while accepting new connection: {e}")
             else:
                 # If a client socket is ready to read, data is available from the client
-                player = player_manager.get(sock)
-                if player:
-                    try:
-                        data = sock.recv(1024)
-                        # print(str(data))
-                        if data:
-                            if data[:2] in [TELNET_WILL_SUPPORT, TELNET_WONT_SUPPORT]: #Client is letting us know if they support GMCP
-                                handle_gmcp_negotiation(data, player)
-                            elif data[:3] == TELNET_GMCP_MSG_START: #Client is sending us a GMCP message
-                                handle_gmcp_message(data, player)
-                            else:
-                                msg = data.decode('utf-8')
-                                player_data[player] = msg.split('\n')  # Split the message into commands
-                    except ConnectionAbortedError:
-                        handle_disconnection(player, "Connection aborted")
-                        sockets.remove(sock)  # Remove the socket from the list
-                    except ConnectionResetError:
-                        handle_disconnection(player, "Connection reset by peer")
-                        sockets.remove(sock)  # Remove the socket from the list
-                    except BlockingIOError:
-                        pass # No data received
-                    except UnicodeDecodeError:
-                        log_error(f"Received invalid data from player {player.fd}")
-                    except socket.timeout:
-                        log_error(f"Socket operation timed out for player {player.fd}")
-                    except BrokenPipeError:
-                        handle_disconnection(player, "Broken pipe")
-                        sockets.remove(sock)  # Remove the socket from the list
-                    except OSError as e:
-                        log_error(f"OS error for player {player.fd}: {e}")
-                        sockets.remove(sock)  # Remove the socket from the list
-                    except socket.error as e:
-                        log_error(f"Socket error while accepting new connection: {e}")
-                    except Exception as e:  # This will catch any other types of exceptions
-                        log_error(f"Unexpected error while reading player input: {e}\n{data}")
-
-        # Then, process all data
-        for player, commands in player_data.items():
-            for command in commands:
-                command = command.strip()  # Remove leading/trailing whitespace
-                if command:  # Ignore empty commands
-                    log_client_input(player, command)
-                    if player.loggedin:
-                        handle_player(player, command)
+                player = key.data
+                sock = key.fileobj
+                if player_manager.get(sock) is not player:
+                    continue # Disconnected earlier in this batch, eg by another player's command
+                if mask & selectors.EVENT_WRITE:
+                    write_output(player)
+                    if player_manager.get(sock) is not player:
+                        continue # Disconnected while writing
+                if not mask & selectors.EVENT_READ:
+                    continue
+                data = b""
+                try:
+                    data = sock.recv(RECV_BUFFER_SIZE)
+                    # print(str(data))
+                    if not data:
+                        handle_disconnection(player, "Connection closed by client")
                     else:
-                        handle_client_login(player, command)
+                        handle_client_data(player, data)
+                except ConnectionAbortedError:
+                    handle_disconnection(player, "Connection aborted")
+                except ConnectionResetError:
+                    handle_disconnection(player, "Connection reset by peer")
+                except BlockingIOError:
+                    pass # No data received
+                except socket.timeout:
+                    log_error(f"Socket operation timed out for player {player.fd}")
+                except BrokenPipeError:
+                    handle_disconnection(player, "Broken pipe")
+                except OSError as e:
+                    log_error(f"OS error for player {player.fd}: {e}")
+                    handle_disconnection(player, "OS error")
+                except Exception as e:  # This will catch any other types of exceptions
+                    log_error(f"Unexpected error while reading player input: {e}\n{data}")
 
-        process_output()
+        # Then, finish any password checks the workers are done with and process queued commands
+        mud_password.run_completed()
+        process_commands()
 
         # Update game state
         update_game_state()
-        
-        # Send all GMCP messages
-        send_gmcp_messages(player_manager.get_players(LoggedIn=True))
 
-        # Sleep for a bit to control the loop's rate
-        time.sleep(0.1)
+        # Send all text and GMCP output, one write per player
+        process_output()
+
+def handle_client_data(player, data):
+    """
+    Handles a chunk of data received from a client, shared by the select and asyncio loops.
+
+    The data is run through the player's telnet parser, telnet negotiation and GMCP messages
+    are handled straight away and the plain text is added to the player's input buffer,
+    with complete lines queued as commands for process_commands.
+    """
+    if player.telnet is None:
+        player.telnet = TelnetParser()
+    text, events = player.telnet.feed(data)
+
+    for event in events:
+        handle_telnet_event(event, player)
+
+    if text:
+        discarded = player.queue_input(text)
+        if discarded:
+            log_error(f"Player {player.fd} command queue is full, discarded {discarded} commands")
+            send_message(player, f"Too many commands queued, {discarded} commands discarded.\n")
+    if player.command_queue and not player.password_pending:
+        player_manager.input_pending[player] = True
+
+def send_wakeup(wakeup_writer):
+    try:
+        wakeup_writer.send(b"\0")
+    except BlockingIOError:
+        pass # Already plenty of wakeups waiting to be read
+
+def process_commands():
+    """
+    Runs queued commands round-robin, at most COMMANDS_PER_PULSE per player per call, so a
+    player pasting hundreds of lines can't hold everyone else's input up. Commands left
+    over are run on the next pass, which the game loop schedules straight away.
+
+    Players in a wait state (eg lag after casting a spell) keep their commands queued until it ends.
+    Players waiting on a password check are dropped from input_pending until it's done, see
+    mud_comms.finish_password_check.
+    """
+    current_time = time.time()
+    for player in list(player_manager.input_pending):
+        for _ in range(COMMANDS_PER_PULSE):
+            if not player.command_queue or player.in_wait_state(current_time) or player.password_pending:
+                break
+            command = player.command_queue.popleft()
+            log_client_input(player, command)
+            if player.loggedin:
+                handle_player(player, command)
+            else:
+                handle_client_login(player, command)
+            if player_manager.get(player.socket) is not player:
+                player.command_queue.clear() # Player disconnected (eg quit), drop the rest of their input
+                break
+        if not player.command_queue or player.password_pending:
+            player_manager.input_pending.pop(player, None)
+
+def seconds_until_next_command(current_time):
+    """
+    Returns the number of seconds until a queued command can be run, 0 if one can run now
+    or None if there are no commands queued.
+    """
+    return min((max(0, player.wait_until - current_time) for player in player_manager.input_pending), default=None)
         
 def update_game_state():
     
     combat_loop()
-    process_output()
-    
     timed_events()
+
+
+# asyncio server mode
+#
+# An alternative to start_server/game_loop: the asyncio event loop owns the sockets and
+# calls into the same handlers, combat rounds and timed events are scheduled with
+# loop.call_later rather than being checked each time round the loop
+
+class AsyncClientSocket:
+    """
+    Socket-like wrapper around an asyncio transport, so Player, process_output etc. can keep
+    calling send/sendall/close without knowing which server mode is running.
+
+    transport.write never blocks, the transport buffers what the client hasn't read yet.
+    A client that falls more than MAX_OUTPUT_BUFFER bytes behind is treated as a
+    broken pipe (and disconnected) rather than being allowed to grow the buffer forever.
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.sock = transport.get_extra_info('socket')
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def sendall(self, data):
+        if self.transport.is_closing():
+            raise BrokenPipeError("Transport is closed")
+        if self.transport.get_write_buffer_size() > MAX_OUTPUT_BUFFER:
+            raise BrokenPipeError("Client is not reading its output")
+        self.transport.write(data)
+
+    def close(self):
+        self.transport.close()
+
+class MudProtocol(asyncio.Protocol):
+    def __init__(self):
+        self.player = None
+
+    def connection_made(self, transport):
+        addr = transport.get_extra_info('peername')
+        if not security_manager.allow_connection(addr[0]):
+            log_info(f"Rejected connection from banned IP {addr}")
+            transport.close()
+            return
+        log_info(f"Accepted connection from {addr}")
+        client_sock = AsyncClientSocket(transport)
+        handle_new_client(client_sock, register=False, address=addr[0])
+        self.player = player_manager.get(client_sock)
+        client_sock.send(TELNET_GMCP_ASK_SUPPORTED) # Ask the client if they support GMCP
+        flush_output()
+
+    def data_received(self, data):
+        if self.player is None:
+            return
+        try:
+            handle_client_data(self.player, data)
+        except Exception as e:  # This will catch any other types of exceptions
+            log_error(f"Unexpected error while reading player input: {e}\n{data}")
+        schedule_command_pulse(asyncio.get_running_loop())
+
+    def connection_lost(self, exc):
+        # handle_disconnection has already run if we closed the connection ourselves
+        if self.player is not None and player_manager.get(self.player.socket) is self.player:
+            handle_disconnection(self.player, f"Connection lost: {exc}" if exc else "Connection closed by client")
+            flush_output()
+
+def flush_output():
     process_output()
 
+# Handle for the next scheduled run of process_commands, if any
+command_pulse = None
+
+def schedule_command_pulse(loop, delay=0):
+    global command_pulse
+    if command_pulse is not None:
+        command_pulse.cancel()
+    command_pulse = loop.call_later(delay, run_command_pulse, loop)
+
+def run_command_pulse(loop):
+    global command_pulse
+    command_pulse = None
+    process_commands()
+    flush_output()
+    # Yield to the event loop between passes, commands left over run on the next one
+    delay = seconds_until_next_command(time.time())
+    if delay is not None:
+        schedule_command_pulse(loop, delay)
+
+def run_password_callbacks(loop):
+    mud_password.run_completed()
+    flush_output()
+    schedule_command_pulse(loop)
+
+def schedule_combat_round(loop):
+    combat_loop()
+    flush_output()
+    loop.call_later(combat_manager.seconds_until_next_round(time.time()), schedule_combat_round, loop)
+
+def schedule_timed_events(loop):
+    timed_events()
+    flush_output()
+    loop.call_later(time_manager.seconds_until_next_event(time.time()), schedule_timed_events, loop)
+
+async def async_game_loop(port):
+    loop = asyncio.get_running_loop()
+    security_manager.load()
+    server = await loop.create_server(MudProtocol, '0.0.0.0', port)
+
+    log_info(f"Server listening on port {port} (asyncio)")
+
+    loop.add_signal_handler(signal.SIGINT, shutdown_handler, signal.SIGINT, None)
+    loop.add_signal_handler(signal.SIGHUP, reload_handler, signal.SIGHUP, None)
+    mud_password.wakeup = lambda: loop.call_soon_threadsafe(run_password_callbacks, loop)
+    loop.call_soon(schedule_combat_round, loop)
+    loop.call_soon(schedule_timed_events, loop)
+
+    async with server:
+        await server.serve_forever()
+
+def start_server_async(port=4000):
+    asyncio.run(async_game_loop(port))
 
 def shutdown_handler(signum, frame):
     handle_shutdown(signum, frame) 
 
+def reload_handler(signum, frame):
+    # Reload the ban list, eg after editing it by hand
+    security_manager.load()
+
 def main():
     log_info(f"Booting up PyMud v{VERSION}...")
     build_world()
     reset_world()
     build_objects()
-    start_server()
+
+    # python mud_server.py [port] [--async]
+    args = sys.argv[1:]
+    port = next((int(arg) for arg in args if arg.isdigit()), 4000)
+    if "--async" in args:
+        start_server_async(port)
+    else:
+        start_server(port)
 
 if __name__ == '__main__':
     main()
@@ -1,8 +1,10 @@
 # mud_shared.py
 
-import shlex
+import sys
 import random
 import re
+import itertools
+from bisect import bisect_left, insort
 from datetime import datetime
 from enum import Enum
 import mud_consts
@@ -188,6 +190,15 @@ def report_mob_health(NPC):
     msg = colourize(first_to_upper(msg), "yellow")
     return msg
 
+def intern_keywords(keywords: str) -> tuple:
+    '''
+    Splits a keyword string (eg from an area file) into a tuple of lowercase, interned keywords.
+
+    Done once when a template, door etc is loaded, so get_keywords() doesn't split the string on every
+    search, and the thousands of instances spawned from the same templates share the same strings.
+    '''
+    return tuple(sys.intern(keyword) for keyword in keywords.lower().split())
+
 def process_keyword(keyword):
     keyword = keyword.lower()
     # Split the keyword into number and actual keyword if applicable
@@ -195,56 +206,125 @@ def process_keyword(keyword):
     number = int(number) - 1 if number is not None and number.isdigit() else None
     return keyword, number
 
-def process_search_output(number, matches):
-    if number is None and matches:
-        return matches[0]
-    elif number is not None and number < len(matches):
-        return matches[number]
-    else:
-        return None
-    
-def search_items(items: set, keyword: str) -> object:
+class KeywordIndex:
     '''
-    Searches for items that match the given keyword.
+    Keeps the keywords of a collection of items (players, mobs, objects etc) in a sorted list, so the items
+    with a keyword starting with a prefix are found with a bisect rather than by asking every item for its keywords.
 
-    This function processes the keyword to separate a number and the actual keyword if applicable.
-    It then creates a list of items that match the keyword, and returns the item corresponding to the number
-    if provided, or the first match if no number is provided.
+    Items are numbered as they are added, from a counter shared by all indexes, and matches are always
+    returned in that order. So 2.guard is the same guard each time, even when searching several indexes.
+    '''
+    sequence = itertools.count()
+
+    def __init__(self):
+        self.keys = [] # sorted (keyword, sequence number)
+        self.entries = {} # item -> (sequence number, keywords)
+        self.items = {} # sequence number -> item, in the order added
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items.values())
+
+    def __contains__(self, item):
+        return item in self.entries
+
+    def add(self, item):
+        if item in self.entries:
+            return
+        number = next(KeywordIndex.sequence)
+        keywords = tuple(item.get_keywords())
+        self.entries[item] = (number, keywords)
+        self.items[number] = item
+        for keyword in keywords:
+            insort(self.keys, (keyword, number))
+
+    def remove(self, item):
+        entry = self.entries.pop(item, None)
+        if entry is None:
+            return
+        number, keywords = entry
+        del self.items[number]
+        for keyword in keywords:
+            index = bisect_left(self.keys, (keyword, number))
+            if index < len(self.keys) and self.keys[index] == (keyword, number):
+                del self.keys[index]
+
+    def clear(self):
+        self.keys.clear()
+        self.entries.clear()
+        self.items.clear()
+
+    def match_numbers(self, prefix):
+        '''
+        Returns the sorted sequence numbers of the items with a keyword starting with prefix.
+        '''
+        keys = self.keys
+        index = bisect_left(keys, (prefix,))
+        numbers = set()
+        while index < len(keys) and keys[index][0].startswith(prefix):
+            numbers.add(keys[index][1])
+            index += 1
+        return sorted(numbers)
+
+    def matches(self, prefix):
+        '''
+        Returns the items with a keyword starting with prefix, in the order they were added.
+        '''
+        return [self.items[number] for number in self.match_numbers(prefix)]
+
+def search_indexes(indexes, keyword: str, condition=None) -> object:
+    '''
+    Searches keyword indexes for an item.
 
     Parameters:
-    items (set): A set of items, each of with have a method for get_keywords() that returns a list of keywords.
+    indexes (list): KeywordIndexes to search, matches from the first index come before those from the second and so on.
     keyword (str): The keyword to search for. Can include a number followed by a dot at the start to specify a particular match.
+    condition (function, optional): Only items for which this returns True are counted, eg lambda obj: obj.is_container().
 
     Returns:
-    object: The item that matches the keyword and corresponds to the number if provided, or the first matchif no number is provided.
+    object: The item that matches the keyword and corresponds to the number if provided, or the first match if no number is provided.
             Returns None if no matches are found or if the number is greater than the number of matches.
-            
+
     Common usage:
-    For search for players and mobs in the room:
-        target = search_items((player.current_room.get_players() | player.current_room.get_mobs()), argument)
-    
-    For searching for keywords (eg for look):
-        all_items = (room.get_players() | player.get_objects() | room.get_mobs() | room.get_objects() | room.get_doors() | room.get_extended_descriptions())
-        item = search_items(all_items, argument)
+        item = search_indexes([room.player_index, player.inventory.index, room.mob_index], argument)
     '''
     if keyword == "" or keyword == None:
         return None
-    
-    # Process the keyword
-    processed_keyword, number = process_keyword(keyword.lower())
 
-    # Create a list of matches
-    matches = [item for item in items if any(kw.startswith(processed_keyword) for kw in item.get_keywords())]
+    processed_keyword, number = process_keyword(keyword)
+    wanted = 0 if number is None else number
+
+    count = 0
+    for index in indexes:
+        for item in index.matches(processed_keyword):
+            if condition is not None and not condition(item):
+                continue
+            if count == wanted:
+                return item
+            count += 1
+    return None
+
+# A token is a run of plain characters and quoted sections, eg 'magic missile' or all.'long sword'.
+# The closing quote is optional so an unbalanced apostrophe ends the token rather than raising an error.
+argument_token_re = re.compile(r'''\s*((?:[^\s'"]+|'[^']*'?|"[^"]*"?)+)''')
+quoted_section_re = re.compile(r'''\'([^']*)\'?|"([^"]*)"?''')
+
+def unquote(token):
+    if "'" not in token and '"' not in token:
+        return token
+    return quoted_section_re.sub(lambda match: match.group(1) if match.group(1) is not None else match.group(2), token)
 
-    # Process the search output
-    return process_search_output(number, matches)
-    
 def parse_argument(argument):
     '''
     Splits the input argument into two parts: the first argument and the remainder.
 
     This function understands quotes and apostrophes, preserving the content inside them as a single token.
-    If the input argument is None or an empty string, both the first argument and the remainder are set to None.
+    An unbalanced quote runs to the end of the argument, eg cast 'magic missile gives "magic missile".
+    Only the first token is split off, the remainder is returned as the rest of the string with
+    its whitespace collapsed and any quotes removed.
+    If the input argument is None, an empty string or only whitespace, both the first argument and the remainder are set to None.
     The remainder is set to None if there are no additional arguments.
 
     Parameters:
@@ -259,17 +339,19 @@ def parse_argument(argument):
     if argument is None or argument == '':
         return None, None
     
-    # Split the argument into tokens
-    tokens = shlex.split(argument)
-
     # The first token is the first argument
-    first = tokens[0] if tokens else None
-
-    # If there are more tokens, the rest of them form the remainder
-    remainder = ' '.join(tokens[1:]) if len(tokens) > 1 else None
+    match = argument_token_re.match(argument)
+    if match is None:
+        return None, None
+    first = unquote(match.group(1)).lower()
 
-    first = first.lower()
-    remainder = remainder.lower() if remainder is not None else None
+    # Whatever follows it forms the remainder
+    rest = argument[match.end():]
+    if "'" in rest or '"' in rest:
+        remainder = ' '.join(unquote(token) for token in argument_token_re.findall(rest))
+    else:
+        remainder = ' '.join(rest.split())
+    remainder = remainder.lower() if remainder else None
 
     return first, remainder
 
@@ -3,7 +3,7 @@
 
 
 
-from mud_shared import first_to_upper, colourize, search_items
+from mud_shared import first_to_upper, colourize
 from mud_comms import send_message, send_room_message
 from mud_objects import room_manager
 
@@ -295,6 +295,7 @@ def sing_callback(player, argument):
             setattr(player.character, 'death_room', 3399)
         elif player.character.death_room is None or player.character.death_room == 3000:
             player.character.death_room = 3399
+            player.character.version += 1
         
         player.move_to_room(room_manager.get(3300))
         send_room_message(player.current_room, f"{player.name} appears in a whirlwind of leaves and light, their eyes wide with wonder.\n", excluded_player=player)
@@ -325,7 +326,7 @@ def handle_social(player, social, argument):
         send_room_message(player.current_room, msg_to_room, excluded_player=player, excluded_msg=msg_to_player)
         # return True
     else:
-        target = search_items((player.current_room.get_players() | player.current_room.get_mobs()), argument)
+        target = player.current_room.search(argument)
         if target is not None:
             msg_to_player = process_message(SOCIALS[social][2], player.name, target.name)
             msg_to_target = process_message(SOCIALS[social][3], player.name, target.name)
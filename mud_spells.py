@@ -7,7 +7,7 @@ from enum import Enum
 import mud_consts
 from mud_consts import RoomFlags
 from mud_comms import send_message, send_room_message_processing, send_room_message
-from mud_shared import colourize, dice_roll, parse_argument, search_items, is_NPC, is_PC, log_error
+from mud_shared import colourize, dice_roll, parse_argument, is_NPC, is_PC, log_error
 from mud_combat import deal_damage
 from mud_objects import combat_manager
 
@@ -37,7 +37,7 @@ def spell_burning_hands(caster, target, spell):
     send_room_message_processing(caster, None, colourize(f"$A utter$s the words 'burning hands'!\n", "yellow"))
     
     mob_count = 0
-    for mob in set(caster.current_room.get_mobs()):
+    for mob in list(caster.current_room.get_mobs()):
         mob_count += 1
         deal_damage(caster, mob, damage, colourize(f"$A point$s at $D and a small flame shoots out, dealing {damage} damage!\n", "red"))
     
@@ -100,7 +100,7 @@ def do_cast_select_target(caster, spell_name, target_type, target_name, combat_t
         # otherwise, target = target_name
         # no target, return none
 
-        target = search_items((caster.current_room.get_players() | caster.current_room.get_mobs()), target_name)
+        target = caster.current_room.search(target_name)
 
         # In combat, no target: target = combat_target
         if combat_manager.in_combat(caster) and target is None and combat_target is not None:
@@ -112,10 +112,10 @@ def do_cast_select_target(caster, spell_name, target_type, target_name, combat_t
         if target_name is None:
             return caster
         
-        return search_items((caster.current_room.get_players() | caster.current_room.get_mobs()), target_name)
+        return caster.current_room.search(target_name)
 
     elif target_type == TargetType.OBJ_INV:
-        return search_items(caster.get_objects(), target_name)
+        return caster.inventory.search(target_name)
     elif target_type == TargetType.IGNORE:
         return None
     else:
@@ -193,8 +193,11 @@ def do_cast(caster, argument):
         return
 
     caster.character.current_mana -= spell.mana_cost
+    caster.character.version += 1
     spell.spell_func(caster, target, spell)
     send_message(caster, caster.character.abilities.used_ability(spell.spell_name))
+    if is_PC(caster):
+        caster.add_wait_state(spell.lag)
     
     
 # for reference: how diku / merc works
@@ -4,10 +4,10 @@ import time
 import random
 
 from mud_comms import send_room_message
-from mud_objects import player_manager, mob_instance_manager, room_manager, object_instance_manager, reset_manager
+from mud_objects import player_manager, mob_instance_manager, room_manager, object_instance_manager, reset_manager, persistence
 from mud_shared import colourize, first_to_upper, log_error, log_info
 from mud_handler import player_movement
-from mud_consts import ObjState, ObjLocationType
+from mud_consts import ObjState, ObjLocationType, SAVE_INTERVAL
 
 class TimeManager:
     def __init__(self):
@@ -21,6 +21,7 @@ class TimeManager:
         self.mini_tick_length = 5 * 1000
         
         self.last_checks = {}
+        self.check_intervals = {}
 
     # tick length (in ms) is 30s +/- 2s (1 std dev)
     def update_tick_length(self):
@@ -55,12 +56,26 @@ class TimeManager:
         'time_interval' is the length of time to check in seconds.
         """
         last_check_time = self.last_checks.get(key, self.startup_time)
+        self.check_intervals[key] = time_interval
 
         if current_time - last_check_time >= time_interval:
             self.last_checks[key] = current_time
             return True
         return False
 
+    def seconds_until_next_event(self, current_time):
+        """
+        Returns the number of seconds until the next tick, mini tick or interval check is due,
+        so the game loop can sleep until then instead of polling.
+        """
+        deadlines = [
+            self.last_tick + self.tick_length / 1000,
+            self.last_mini_tick + self.mini_tick_length / 1000,
+        ]
+        for key, time_interval in self.check_intervals.items():
+            deadlines.append(self.last_checks.get(key, self.startup_time) + time_interval)
+        return max(0, min(deadlines) - current_time)
+
 class ImpManager: 
     def __init__(self):
         self.imp_list = set() # list of objects to imp
@@ -155,6 +170,9 @@ def timed_events():
     if time_manager.check_length_has_passed('obj_save', 60 * 15, current_time):
         object_instance_manager.save_objects()
 
+    if time_manager.check_length_has_passed('save', SAVE_INTERVAL, current_time):
+        persistence.flush()
+
         
         
         
\ No newline at end of file
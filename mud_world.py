@@ -96,10 +96,9 @@ def parse_mob(lines):
     
 def parse_object(lines):
     obj_vnum = int(lines[0][1:])
-    current_object = ObjectTemplate(obj_vnum)
     offset = 1
-    current_object.keywords, offset_add = parse_multi_line(lines[offset:])
-    current_object.keywords = current_object.keywords.lower()
+    keywords, offset_add = parse_multi_line(lines[offset:])
+    current_object = ObjectTemplate(obj_vnum, keywords)
     offset += offset_add
     current_object.short_desc, offset_add = parse_multi_line(lines[offset:])
     offset += offset_add
@@ -0,0 +1,25 @@
+import pickle
+import unittest
+
+from mud_abilities import LearnedAbility, AbilityType
+from mud_objects import Character, Equipment, player_db
+
+class TestDecodePickledPlayer(unittest.TestCase):
+    def pickled_character(self):
+        character = Character()
+        ability = LearnedAbility('magic missile', AbilityType.SPELL, level=2, experience=200)
+        # As pickled before sublevel and is_locked were added
+        del ability.sublevel
+        del ability.is_locked
+        character.abilities.abilities[ability.name] = ability
+        return pickle.dumps(character)
+
+    def test_ability_missing_attributes(self):
+        character, equipment = player_db.decode_player(None, self.pickled_character(), pickle.dumps(Equipment()))
+        ability = character.abilities.abilities['magic missile']
+        self.assertEqual(ability.level, 2)
+        self.assertEqual(ability.sublevel, 3) # 200 of the 400 experience needed for level 3
+        self.assertFalse(ability.is_locked)
+
+if __name__ == '__main__':
+    unittest.main()